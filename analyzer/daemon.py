@@ -0,0 +1,210 @@
+import asyncio
+import functools
+import logging
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from cborguploader.metrics import metrics
+from pipeline import (
+    RUNNER_IMAGE, check_pangenome, fail_sample, finalize_sample,
+    get_cr_states, list_new_reads, refresh_workflows, register_reads,
+    submit_sample, submittable_samples)
+
+# Initial and maximum seconds between polls of a job, by container state
+POLL_BACKOFF = {
+    'Uncommitted': (30, 600),
+    'Committed': (30, 600),
+    'Queued': (60, 1800),
+    'On hold': (300, 3600),
+    'Locked': (60, 900),
+    'Running': (60, 900),
+    'Warning': (60, 900),
+    'Failing': (30, 300),
+}
+DEFAULT_BACKOFF = (30, 600)
+
+
+class Backoff(object):
+    """Exponential backoff between polls that restarts on state changes."""
+
+    def __init__(self):
+        self._jobs = {}
+
+    def due(self, key, now):
+        return key not in self._jobs or self._jobs[key][2] <= now
+
+    def update(self, key, state, now):
+        last_state, attempts, _ = self._jobs.get(key, (None, 0, 0))
+        attempts = attempts + 1 if state == last_state else 0
+        initial, maximum = POLL_BACKOFF.get(state, DEFAULT_BACKOFF)
+        delay = min(maximum, initial * 2 ** attempts)
+        self._jobs[key] = (state, attempts, now + delay)
+        return delay
+
+    def forget(self, key):
+        self._jobs.pop(key, None)
+
+
+class AnalyzerDaemon(object):
+    """Runs the analyzer continuously on an asyncio event loop.
+
+    Discovery, submission, polling, finalization and the pangenome runs are
+    independent tasks connected by queues. Blocking API calls go through a thread pool
+    and at most api_concurrency of them run at the same time.
+    """
+
+    def __init__(self, api, store, uploader_project, workflows_project,
+                 fasta_workflow_uuid, pangenome_workflow_uuid,
+                 pangenome_result_col_uuid, api_concurrency=8,
+                 submit_jobs=4, poll_interval=60, pangenome_options=None,
+                 runner_image=RUNNER_IMAGE, metrics_out=None):
+        self.api = api
+        self.store = store
+        self.uploader_project = uploader_project
+        self.workflows_project = workflows_project
+        self.fasta_workflow_uuid = fasta_workflow_uuid
+        self.pangenome_workflow_uuid = pangenome_workflow_uuid
+        self.pangenome_result_col_uuid = pangenome_result_col_uuid
+        self.pangenome_options = pangenome_options or {}
+        self.runner_image = runner_image
+        self.api_concurrency = api_concurrency
+        self.submit_jobs = submit_jobs
+        self.poll_interval = poll_interval
+        self.metrics_out = metrics_out
+        self.backoff = Backoff()
+        self._in_flight = set()
+
+    async def call(self, fn, *args):
+        """Runs a blocking API call in the thread pool."""
+        async with self._api_slots:
+            return await self._loop.run_in_executor(self._executor, fn, *args)
+
+    async def sleep(self, seconds):
+        try:
+            await asyncio.wait_for(self._stopping.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    async def discover(self):
+        while not self._stopping.is_set():
+            refresh_workflows()
+            try:
+                reads = await self.call(
+                    list_new_reads, self.api, self.uploader_project,
+                    self.store.get_meta('last_modified_at'),
+                    self.store.get_meta('last_uuid'))
+                register_reads(self.store, reads)
+                for sample_id, sample_state in submittable_samples(self.store):
+                    if sample_id not in self._in_flight:
+                        self._in_flight.add(sample_id)
+                        await self.submit_queue.put((sample_id, sample_state))
+            except Exception:
+                logging.exception('Listing new uploads failed')
+            if self.metrics_out is not None:
+                metrics.write(self.metrics_out)
+            await self.sleep(self.poll_interval)
+
+    async def submit(self):
+        while True:
+            sample_id, sample_state = await self.submit_queue.get()
+            try:
+                await self.call(
+                    submit_sample, self.api, self.store,
+                    self.workflows_project, self.fasta_workflow_uuid,
+                    sample_id, sample_state, self.runner_image)
+            except Exception:
+                logging.exception('Submitting %s failed', sample_id)
+            finally:
+                self._in_flight.discard(sample_id)
+                self.submit_queue.task_done()
+
+    async def poll(self):
+        while not self._stopping.is_set():
+            now = time.monotonic()
+            due = [(sample_id, sample_state) for sample_id, sample_state
+                   in self.store.samples_with_status('submitted')
+                   if sample_state['container_request'] is not None
+                   and sample_id not in self._in_flight
+                   and self.backoff.due(sample_id, now)]
+            if due:
+                try:
+                    cr_states = await self.call(
+                        get_cr_states, self.api,
+                        [s['container_request'] for _, s in due])
+                except Exception:
+                    logging.exception('Polling container requests failed')
+                    cr_states = {}
+                for sample_id, sample_state in due:
+                    if sample_state['container_request'] not in cr_states:
+                        continue
+                    cr, cr_state = cr_states[sample_state['container_request']]
+                    self.store.set_container_request_state(cr['uuid'], cr_state)
+                    if cr_state == 'Complete':
+                        self.backoff.forget(sample_id)
+                        self._in_flight.add(sample_id)
+                        await self.finalize_queue.put(
+                            (sample_id, sample_state, cr))
+                    elif cr_state == 'Failed':
+                        self.backoff.forget(sample_id)
+                        fail_sample(self.store, sample_id)
+                    else:
+                        self.backoff.update(sample_id, cr_state, now)
+            await self.sleep(min(self.poll_interval, DEFAULT_BACKOFF[0]))
+
+    async def finalize(self):
+        while True:
+            sample_id, sample_state, cr = await self.finalize_queue.get()
+            try:
+                await self.call(
+                    finalize_sample, self.api, self.store, sample_id,
+                    sample_state, cr)
+                print(f'Analysis of {sample_id} is complete')
+            except Exception:
+                logging.exception('Finalizing %s failed', sample_id)
+            finally:
+                self._in_flight.discard(sample_id)
+                self.finalize_queue.task_done()
+
+    async def pangenome(self):
+        # Merging inputs and submitting the pangenome workflow can take a
+        # while, so it does not hold up the listing of new uploads
+        while not self._stopping.is_set():
+            try:
+                await self.call(functools.partial(
+                    check_pangenome, self.api, self.store,
+                    self.workflows_project, self.pangenome_workflow_uuid,
+                    self.pangenome_result_col_uuid,
+                    runner_image=self.runner_image,
+                    **self.pangenome_options))
+            except Exception:
+                logging.exception('Checking the pangenome failed')
+            await self.sleep(self.poll_interval)
+
+    async def run(self):
+        self._loop = asyncio.get_running_loop()
+        self._stopping = asyncio.Event()
+        self._api_slots = asyncio.Semaphore(self.api_concurrency)
+        self._executor = ThreadPoolExecutor(max_workers=self.api_concurrency)
+        self.submit_queue = asyncio.Queue()
+        self.finalize_queue = asyncio.Queue()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            self._loop.add_signal_handler(sig, self._stopping.set)
+        workers = [asyncio.ensure_future(self.submit())
+                   for _ in range(self.submit_jobs)]
+        workers += [asyncio.ensure_future(self.finalize())
+                    for _ in range(self.submit_jobs)]
+        try:
+            await asyncio.gather(
+                self.discover(), self.poll(), self.pangenome())
+            # Let queued work finish before shutting down
+            await self.submit_queue.join()
+            await self.finalize_queue.join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            self._executor.shutdown(wait=True)
+
+
+def run_daemon(*args, **kwargs):
+    asyncio.run(AnalyzerDaemon(*args, **kwargs).run())
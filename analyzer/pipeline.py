@@ -0,0 +1,587 @@
+# Submission and polling of the analysis workflows, shared by the analyzer
+# command and its daemon
+import logging
+import os
+import re
+import threading
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+
+import arvados
+import arvados.collection
+import arvados.util
+import yaml
+from arvados.collection import CollectionReader
+
+from cborguploader.metrics import count, span, timed
+
+ARVADOS_API_HOST = os.environ.get('ARVADOS_API_HOST', 'cborg.cbrc.kaust.edu.sa')
+ARVADOS_API_TOKEN = os.environ.get('ARVADOS_API_TOKEN', '')
+# Number of uuids per "in" filter when fetching records in batches
+LIST_BATCH_SIZE = 100
+# Image and priority of the arvados-cwl-runner containers
+RUNNER_IMAGE = os.environ.get('ARVADOS_RUNNER_IMAGE', 'arvados/jobs:2.0.3')
+RUNNER_PRIORITY = 500
+METADATA_SCHEMA_URL = 'https://raw.githubusercontent.com/bio-ontology-research-group/cborguploader/master/cborguploader/schema.yml'
+# Prefix of the RDF subjects of the samples in the pangenome
+SUBJECT_BASE = 'http://cborg.cbrc.kaust.edu.sa/sample/'
+# Samples merged into the pangenome input collection per tick
+MERGE_BATCH_SIZE = 1000
+PANGENOME_INPUTS_NAME = 'Pangenome inputs'
+
+SubmitResult = namedtuple(
+    'SubmitResult', ['container_request', 'status', 'error'])
+
+_packed_workflows = {}
+_checked_workflows = set()
+_packed_workflows_lock = threading.Lock()
+
+def refresh_workflows():
+    """Makes the next packed_workflow call of every workflow check whether
+    it was registered again. Called once per tick."""
+    with _packed_workflows_lock:
+        _checked_workflows.clear()
+
+def packed_workflow(api, workflow_uuid):
+    """Returns the packed CWL of a registered workflow, parsed again only
+    when its modified_at changed."""
+    with _packed_workflows_lock:
+        if workflow_uuid not in _checked_workflows:
+            wf = api.workflows().get(uuid=workflow_uuid).execute()
+            cached = _packed_workflows.get(workflow_uuid)
+            if cached is None or cached[0] != wf['modified_at']:
+                if cached is not None:
+                    logging.info('Workflow %s was updated at %s',
+                                 workflow_uuid, wf['modified_at'])
+                _packed_workflows[workflow_uuid] = (
+                    wf['modified_at'], yaml.safe_load(wf['definition']))
+            _checked_workflows.add(workflow_uuid)
+        return _packed_workflows[workflow_uuid][1]
+
+def check_runner_image(api, image):
+    """Raises ValueError unless the runner image was uploaded to Arvados,
+    which arvados-cwl-runner --submit would otherwise do."""
+    if re.match(r'^[0-9a-f]{32}\+\d+$', image):
+        found = api.collections().list(
+            filters=[['portable_data_hash', '=', image]], limit=1).execute()
+        hint = 'no collection has that portable data hash'
+    else:
+        repo_tag = image if ':' in image.rsplit('/', 1)[-1] else image + ':latest'
+        found = api.links().list(
+            filters=[['link_class', '=', 'docker_image_repo+tag'],
+                     ['name', '=', repo_tag]], limit=1).execute()
+        hint = 'upload it with arv-keepdocker %s' % ' '.join(
+            repo_tag.rsplit(':', 1))
+    if not found['items']:
+        raise ValueError(
+            'Runner image %s is not in Arvados, %s' % (image, hint))
+
+def check_inputs(inputobj):
+    """Raises ValueError if an input is not in Keep or on the web.
+
+    The runner container can only read those, local files would have to be
+    uploaded first.
+    """
+    if isinstance(inputobj, dict):
+        if inputobj.get('class') in ('File', 'Directory'):
+            location = inputobj.get('location', '')
+            if not location.startswith(('keep:', 'http://', 'https://')):
+                raise ValueError('Input %s is not in Keep' % location)
+        for value in inputobj.values():
+            check_inputs(value)
+    elif isinstance(inputobj, list):
+        for value in inputobj:
+            check_inputs(value)
+
+def runner_request(workflow_uuid, workflow, project_uuid, name, inputobj,
+                   runner_image=RUNNER_IMAGE):
+    """Builds the container request that arvados-cwl-runner --submit would
+    create to run the workflow."""
+    return {
+        "name": name,
+        "owner_uuid": project_uuid,
+        "state": "Committed",
+        "priority": RUNNER_PRIORITY,
+        "container_image": runner_image,
+        "command": ["arvados-cwl-runner", "--local", "--api=containers",
+                    "--no-log-timestamps", "--disable-validate",
+                    "--eval-timeout=20", "--thread-count=1",
+                    "--enable-reuse", "--collection-cache-size=256",
+                    "--project-uuid=%s" % project_uuid,
+                    "/var/lib/cwl/workflow.json#main",
+                    "/var/lib/cwl/cwl.input.json"],
+        "mounts": {
+            "/var/lib/cwl/workflow.json": {"kind": "json", "content": workflow},
+            "/var/lib/cwl/cwl.input.json": {"kind": "json", "content": inputobj},
+            "/var/spool/cwl": {"kind": "collection", "writable": True},
+            "stdout": {"kind": "file", "path": "/var/spool/cwl/cwl.output.json"},
+        },
+        "output_path": "/var/spool/cwl",
+        "cwd": "/var/spool/cwl",
+        "runtime_constraints": {
+            "vcpus": 1,
+            "ram": 1024 * 1024 * 1024,
+            "API": True,
+        },
+        "use_existing": True,
+        "properties": {"template_uuid": workflow_uuid},
+    }
+
+@timed('api.run_workflow')
+def run_workflow(api, parent_project, workflow_uuid, name, inputobj,
+                 runner_image=RUNNER_IMAGE):
+    try:
+        check_inputs(inputobj)
+        workflow = packed_workflow(api, workflow_uuid)
+        project = api.groups().create(body={
+            "group_class": "project",
+            "name": name,
+            "owner_uuid": parent_project,
+        }, ensure_unique_name=True).execute()
+        cr = api.container_requests().create(body=runner_request(
+            workflow_uuid, workflow, project["uuid"], name, inputobj,
+            runner_image)).execute()
+    except Exception as e:
+        logging.error("Submitting %s failed: %s", name, e)
+        return SubmitResult(None, 'error', str(e))
+    logging.info("Submitted %s as %s", name, cr["uuid"])
+    return SubmitResult(cr["uuid"], 'submitted', None)
+
+def container_state(cr, c):
+    """Returns the display state of a container request given its container."""
+    if c is None:
+        return cr['state']
+    if cr['state'] == 'Final' and c['state'] != 'Complete':
+        return 'Cancelled'
+    elif c['state'] in ['Locked', 'Queued']:
+        if c['priority'] == 0:
+            return 'On hold'
+        else:
+            return 'Queued'
+    elif c['state'] == 'Complete' and c['exit_code'] != 0:
+        return 'Failed'
+    elif c['state'] == 'Running':
+        if c['runtime_status'].get('error', None):
+            return 'Failing'
+        elif c['runtime_status'].get('warning', None):
+            return 'Warning'
+    return c['state']
+
+def get_cr_state(api, cr):
+    if cr['container_uuid'] is None:
+        return cr['state']
+    c = api.containers().get(uuid=cr['container_uuid']).execute()
+    return container_state(cr, c)
+
+def list_by_uuid(list_method, uuids, field='uuid', **kwargs):
+    """Fetches the records with the given uuids, or other values of field,
+    with a few list calls.
+
+    Returns a dict from the value of field to record.
+    """
+    uuids = list(uuids)
+    items = {}
+    for i in range(0, len(uuids), LIST_BATCH_SIZE):
+        with span('api.list_by_uuid'):
+            batch = arvados.util.list_all(
+                list_method,
+                filters=[[field, "in", uuids[i:i + LIST_BATCH_SIZE]]],
+                **kwargs)
+        for item in batch:
+            items[item[field]] = item
+    return items
+
+def get_cr_states(api, cr_uuids):
+    """Returns the container requests and their states for many uuids using
+    batched list calls for both container requests and containers."""
+    crs = list_by_uuid(api.container_requests().list, cr_uuids)
+    containers = list_by_uuid(
+        api.containers().list,
+        set(cr['container_uuid'] for cr in crs.values()
+            if cr['container_uuid'] is not None))
+    return {uuid: (cr, container_state(cr, containers.get(cr['container_uuid'])))
+            for uuid, cr in crs.items()}
+
+
+def submit_new_request(
+        api, workflows_project, workflow_uuid, sample_id,
+        portable_data_hash, is_paired, reads1_file='reads1.fastq',
+        reads2_file='reads2.fastq', runner_image=RUNNER_IMAGE):
+    inputobj = {
+        "ref_fasta": {
+            "class": "File",
+            "location": "keep:9df5dcc0054bfc9e588f1273e9974c72+474/NC_045512.2.fasta"
+        },
+        "sample_id": sample_id
+    }
+    inputobj["fastq_forward"] = {
+        "class": "File",
+        "location": "keep:%s/%s" % (portable_data_hash, reads1_file)
+    }
+    if is_paired:
+        inputobj["fastq_reverse"] = {
+            "class": "File",
+            "location": "keep:%s/%s" % (portable_data_hash, reads2_file)
+        }
+    name = f'Generate FASTA for {sample_id}'
+    return run_workflow(
+        api, workflows_project, workflow_uuid, name, inputobj, runner_image)
+
+
+def previous_pangenome_files(api, previous_output, names):
+    """Returns the File inputs for the files of a previous pangenome output
+    collection, for those of the (input, file name) pairs in names that
+    it has."""
+    if previous_output is None:
+        return {}
+    col = CollectionReader(previous_output, api_client=api, num_retries=5)
+    return {name: {"class": "File",
+                   "location": f'keep:{previous_output}/{filename}'}
+            for name, filename in names if col.exists(filename)}
+
+def submit_pangenome(
+        api, workflows_project, pangenome_workflow_uuid, inputs_pdh,
+        previous_output=None, runner_image=RUNNER_IMAGE):
+    """Submits the pangenome workflow for all samples merged into the
+    pangenome input collection with the given portable data hash.
+
+    The dedup index and RDF cache of a previous output collection are
+    reused if it has them.
+    """
+    inputobj = {
+        "samples": {
+            "class": "Directory",
+            "location": f'keep:{inputs_pdh}'
+        },
+        "metadataSchema": {
+            "class": "File",
+            "location": METADATA_SCHEMA_URL
+        },
+        "subjectBase": SUBJECT_BASE,
+    }
+    inputobj.update(previous_pangenome_files(
+        api, previous_output, [("previousIndex", "dedupIndex.tsv"),
+                               ("previousRDFCache", "rdfCache.sqlite")]))
+    name = f'Pangenome analysis for'
+    return run_workflow(
+        api, workflows_project, pangenome_workflow_uuid, name, inputobj,
+        runner_image)
+
+
+# Files of a previous pangenome output that an incremental run extends,
+# the dedup index and RDF cache only save work and may be missing
+INCREMENTAL_INPUTS = [("previousDedup", "readsMergeDedup.fasta"),
+                      ("previousPAF", "readsMergeDedup.paf"),
+                      ("previousMetadata", "mergedmetadata.ttl")]
+INCREMENTAL_CACHES = [("previousIndex", "dedupIndex.tsv"),
+                      ("previousRDFCache", "rdfCache.sqlite")]
+
+def incremental_inputs(api, previous_output):
+    """Returns the inputs an incremental run takes from a previous output
+    collection, or None if the collection lacks one it needs."""
+    files = previous_pangenome_files(
+        api, previous_output, INCREMENTAL_INPUTS + INCREMENTAL_CACHES)
+    missing = [filename for name, filename in INCREMENTAL_INPUTS
+               if name not in files]
+    if missing:
+        logging.warning('Pangenome output %s has no %s',
+                        previous_output, ', '.join(missing))
+        return None
+    return files
+
+def submit_incremental_pangenome(
+        api, workflows_project, workflow_uuid, data, previous_inputs=None,
+        runner_image=RUNNER_IMAGE):
+    """Submits pangenome-incremental.cwl for the genomes in data, a list of
+    (sample_id, portable_data_hash) pairs, on top of the previous output
+    files from incremental_inputs. Without them the pangenome is built
+    from the genomes in data alone."""
+    inputobj = {
+        "inputReads": [],
+        "metadata": [],
+        "metadataSchema": {
+            "class": "File",
+            "location": METADATA_SCHEMA_URL
+        },
+        "subjects": [],
+    }
+    for s_id, pdh in data:
+        inputobj["inputReads"].append({
+            "class": "File",
+            "location": f'keep:{pdh}/sequence.fasta'})
+        inputobj["metadata"].append({
+            "class": "File",
+            "location": f'keep:{pdh}/metadata.yaml'})
+        inputobj["subjects"].append(SUBJECT_BASE + s_id)
+    if previous_inputs is not None:
+        inputobj.update(previous_inputs)
+        name = f'Incremental pangenome analysis for {len(data)} new genomes'
+    else:
+        name = f'Pangenome analysis for {len(data)} genomes'
+    return run_workflow(
+        api, workflows_project, workflow_uuid, name, inputobj, runner_image)
+
+
+@timed('api.list_new_reads')
+def list_new_reads(api, uploader_project, modified_since=None,
+                   last_uuid=None, page_size=1000):
+    """Lists the uploads in the project and its subprojects that were
+    created or modified since the given time, oldest first.
+
+    Pages are requested by key rather than by offset, continuing after the
+    (modified_at, uuid) of the last collection seen, so collections that
+    are modified while listing are neither skipped nor listed twice. The
+    listing starts after last_uuid among the collections modified at
+    modified_since, or with all of them if it is not given.
+    """
+    subprojects = arvados.util.list_all(
+        api.groups().list, filters=[["owner_uuid", "=", uploader_project]],
+        select=["uuid"])
+    owners = [uploader_project] + [sp['uuid'] for sp in subprojects]
+
+    def page(filters, limit):
+        return api.collections().list(
+            filters=[["owner_uuid", "in", owners]] + filters,
+            order=["modified_at asc", "uuid asc"], limit=limit, count="none",
+            select=["uuid", "portable_data_hash", "properties",
+                    "modified_at"]).execute()['items']
+
+    reads = []
+    while True:
+        # The filters of a request are combined with AND, so the rest of
+        # the collections modified at the same time as the last one are
+        # listed before the newer ones
+        items = []
+        if modified_since is not None and last_uuid is not None:
+            items = page([["modified_at", "=", modified_since],
+                          ["uuid", ">", last_uuid]], page_size)
+        if len(items) < page_size:
+            if modified_since is None:
+                newer = []
+            elif last_uuid is None:
+                newer = [["modified_at", ">=", modified_since]]
+            else:
+                newer = [["modified_at", ">", modified_since]]
+            items += page(newer, page_size - len(items))
+        if not items:
+            return reads
+        reads.extend(items)
+        modified_since = items[-1]['modified_at']
+        last_uuid = items[-1]['uuid']
+
+
+def register_reads(store, reads):
+    """Records new and modified uploads and advances the high-water mark.
+
+    reads is a complete listing from list_new_reads, the mark is moved to
+    its last collection once all of them are recorded.
+    """
+    for it in reads:
+        if 'sequence_label' in it['properties']:
+            sample_id = it['properties']['sequence_label']
+            sample = {
+                'uuid': it['uuid'],
+                'portable_data_hash': it['portable_data_hash'],
+                'is_fasta': it['properties'].get('is_fasta', False),
+                'is_paired': it['properties'].get('is_paired', False),
+                'reads1_file': it['properties'].get('reads1_file', 'reads1.fastq'),
+                'reads2_file': it['properties'].get('reads2_file', 'reads2.fastq'),
+            }
+            if 'analysis_status' in it['properties']:
+                sample['status'] = 'complete'
+            store.update_sample(sample_id, **sample)
+    if reads:
+        store.set_meta('last_modified_at', reads[-1]['modified_at'])
+        store.set_meta('last_uuid', reads[-1]['uuid'])
+
+
+def submittable_samples(store):
+    return [
+        (sample_id, sample_state)
+        for sample_id, sample_state in store.samples_with_status('new')
+        if sample_state['uuid'] is not None and not sample_state['is_fasta']]
+
+
+def submit_sample(api, store, workflows_project, fasta_workflow_uuid,
+                  sample_id, sample_state, runner_image=RUNNER_IMAGE):
+    result = submit_new_request(
+        api, workflows_project, fasta_workflow_uuid, sample_id,
+        sample_state['portable_data_hash'], sample_state['is_paired'],
+        sample_state['reads1_file'], sample_state['reads2_file'],
+        runner_image)
+    store.update_sample(
+        sample_id, status=result.status,
+        container_request=result.container_request)
+    if result.status == 'submitted':
+        count('samples_submitted')
+        print(f'Submitted analysis request for {sample_id}')
+    return result
+
+
+@timed('api.finalize_sample')
+def finalize_sample(api, store, sample_id, sample_state, cr):
+    """Copies the workflow outputs into the reads collection."""
+    col = api.collections().get(uuid=sample_state['uuid']).execute()
+    out_col = api.collections().get(uuid=cr["output_uuid"]).execute()
+    col['properties']['analysis_status'] = 'complete'
+    col = api.collections().update(
+        uuid=col['uuid'],
+        body={"manifest_text": col["manifest_text"] + out_col["manifest_text"],
+              "properties": col["properties"]}).execute()
+    store.update_sample(
+        sample_id, status='complete',
+        output_collection=cr["output_uuid"],
+        portable_data_hash=col['portable_data_hash'])
+    count('samples_completed')
+
+
+def fail_sample(store, sample_id):
+    # Failed samples are submitted again
+    count('samples_failed')
+    store.update_sample(
+        sample_id, status='new', container_request=None,
+        output_collection=None)
+
+
+def pangenome_due(store, last_run, every=0, interval=0):
+    """Returns the samples for the next pangenome run if one is due after
+    every new complete samples or interval minutes, otherwise None."""
+    pending = store.pending_pangenome_samples()
+    if not pending or (not every and not interval):
+        return None
+    if every and len(pending) >= every:
+        return pending
+    if interval:
+        if last_run is None:
+            return pending
+        last_time = datetime.fromisoformat(last_run['submitted_at'])
+        if datetime.now(timezone.utc) - last_time >= timedelta(minutes=interval):
+            return pending
+    return None
+
+
+@timed('update_pangenome_inputs')
+def update_pangenome_inputs(api, store, workflows_project,
+                            batch_size=MERGE_BATCH_SIZE):
+    """Merges newly complete samples into the collection the pangenome
+    workflow reads its inputs from, as a <sample> directory holding the
+    sequence.fasta and metadata.yaml of the sample and the <sample>.gff
+    file if it has one. Its sources.tsv lists the portable data hash of
+    the collection every sample was copied from, which the pangenome
+    workflow uses to tell which samples changed. The collection is created
+    in workflows_project on first use.
+
+    Only the manifests of the new samples are fetched and the collection is
+    saved once per call. Samples whose collection was not found are merged
+    by a later call. Returns the number of merged samples.
+    """
+    samples = store.unmerged_pangenome_inputs(batch_size)
+    if not samples:
+        return 0
+    manifests = list_by_uuid(
+        api.collections().list,
+        set(sample_state['portable_data_hash'] for _, sample_state in samples),
+        field='portable_data_hash',
+        select=['portable_data_hash', 'manifest_text'])
+    inputs_uuid = store.get_meta('pangenome_inputs')
+    if inputs_uuid is None:
+        inputs_uuid = api.collections().create(
+            body={'owner_uuid': workflows_project,
+                  'name': PANGENOME_INPUTS_NAME, 'manifest_text': ''},
+            ensure_unique_name=True).execute()['uuid']
+        store.set_meta('pangenome_inputs', inputs_uuid)
+    inputs = arvados.collection.Collection(
+        inputs_uuid, api_client=api, num_retries=5)
+    merged = []
+    for sample_id, sample_state in samples:
+        pdh = sample_state['portable_data_hash']
+        if pdh not in manifests:
+            # The collection changed since it was listed, the next listing
+            # updates its portable data hash
+            logging.warning('Collection %s of %s not found, will retry',
+                            pdh, sample_id)
+            continue
+        src = CollectionReader(manifests[pdh]['manifest_text'])
+        copies = [(name, name) for name in (sample_id, f'{sample_id}.gff')]
+        copies += [(name, f'{sample_id}/{name}')
+                   for name in ('sequence.fasta', 'metadata.yaml')]
+        for name, target in copies:
+            if src.exists(name):
+                inputs.copy(name, target, source_collection=src,
+                            overwrite=True)
+        missing = [name for name in ('sequence.fasta', 'metadata.yaml')
+                   if not inputs.exists(f'{sample_id}/{name}')]
+        if missing:
+            # This version of the collection will not get them, it is
+            # merged again once it changes
+            logging.warning('%s has no %s, it is left out of the pangenome',
+                            sample_id, ', '.join(missing))
+        merged.append((sample_id, pdh))
+    if merged:
+        sources = dict(store.pangenome_inputs())
+        sources.update(merged)
+        with inputs.open('sources.tsv', 'w') as f:
+            f.write(''.join('%s\t%s\n' % source
+                            for source in sorted(sources.items())))
+        inputs.save()
+        store.set_meta('pangenome_inputs_pdh', inputs.portable_data_hash())
+        store.add_pangenome_inputs(merged)
+    count('pangenome_inputs_merged', len(merged))
+    return len(merged)
+
+
+@timed('check_pangenome')
+def check_pangenome(api, store, workflows_project, pangenome_workflow_uuid,
+                    pangenome_result_col_uuid, incremental_workflow_uuid=None,
+                    pangenome_every=0, pangenome_interval=0,
+                    runner_image=RUNNER_IMAGE):
+    if incremental_workflow_uuid is None and (
+            pangenome_every or pangenome_interval):
+        update_pangenome_inputs(api, store, workflows_project)
+    last_run = store.last_pangenome_run()
+    if last_run is not None and last_run['status'] == 'submitted':
+        cr = api.container_requests().get(
+            uuid=last_run["container_request"]).execute()
+        cr_state = get_cr_state(api, cr)
+        print(f'Container request for pangenome workflow is {cr_state}')
+        store.set_container_request_state(cr['uuid'], cr_state)
+        if cr_state == 'Complete':
+            print('Updating results collection')
+            out_col = api.collections().get(uuid=cr["output_uuid"]).execute()
+            api.collections().update(
+                uuid=pangenome_result_col_uuid,
+                body={"manifest_text": out_col["manifest_text"]}).execute()
+            store.set_meta('pangenome_output', out_col['portable_data_hash'])
+            store.complete_pangenome_run(last_run['id'])
+        elif cr_state in ('Failed', 'Cancelled'):
+            store.fail_pangenome_run(last_run['id'])
+        return
+    pending = pangenome_due(
+        store, last_run, pangenome_every, pangenome_interval)
+    if pending is None:
+        return
+    if incremental_workflow_uuid is not None:
+        previous_output = store.get_meta('pangenome_output')
+        previous_inputs = None
+        if previous_output is not None:
+            previous_inputs = incremental_inputs(api, previous_output)
+        if previous_inputs is None:
+            # Nothing to extend, build the pangenome from every sample
+            pending = store.samples_with_status('complete')
+        container_request, status, error = submit_incremental_pangenome(
+            api, workflows_project, incremental_workflow_uuid,
+            [(sample_id, sample_state['portable_data_hash'])
+             for sample_id, sample_state in pending],
+            previous_inputs, runner_image)
+    else:
+        if store.unmerged_pangenome_inputs(1):
+            # Wait until the merges of the following ticks caught up
+            return
+        container_request, status, error = submit_pangenome(
+            api, workflows_project, pangenome_workflow_uuid,
+            store.get_meta('pangenome_inputs_pdh'),
+            store.get_meta('pangenome_output'), runner_image)
+    if status == 'submitted':
+        store.add_pangenome_run(
+            container_request, [sample_id for sample_id, _ in pending])
+        print('Submitted pangenome request', container_request)
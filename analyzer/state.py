@@ -0,0 +1,276 @@
+import fcntl
+import json
+import logging
+import sqlite3
+import threading
+from datetime import datetime, timezone
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS samples (
+    sample_id TEXT PRIMARY KEY,
+    uuid TEXT,
+    status TEXT NOT NULL,
+    container_request TEXT,
+    output_collection TEXT,
+    portable_data_hash TEXT,
+    is_fasta INTEGER NOT NULL DEFAULT 0,
+    is_paired INTEGER NOT NULL DEFAULT 0,
+    reads1_file TEXT,
+    reads2_file TEXT,
+    updated_at TEXT
+);
+CREATE INDEX IF NOT EXISTS samples_status ON samples (status);
+CREATE TABLE IF NOT EXISTS container_requests (
+    uuid TEXT PRIMARY KEY,
+    sample_id TEXT,
+    kind TEXT NOT NULL,
+    state TEXT,
+    submitted_at TEXT
+);
+CREATE INDEX IF NOT EXISTS container_requests_sample
+    ON container_requests (sample_id);
+CREATE TABLE IF NOT EXISTS pangenome_runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    container_request TEXT,
+    status TEXT NOT NULL,
+    submitted_at TEXT,
+    completed_at TEXT
+);
+CREATE TABLE IF NOT EXISTS pangenome_members (
+    sample_id TEXT PRIMARY KEY,
+    run_id INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pangenome_inputs (
+    sample_id TEXT PRIMARY KEY,
+    portable_data_hash TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+SAMPLE_FIELDS = [
+    'uuid', 'status', 'container_request', 'output_collection',
+    'portable_data_hash', 'is_fasta', 'is_paired', 'reads1_file',
+    'reads2_file']
+
+
+def now():
+    return datetime.now(timezone.utc).isoformat()
+
+
+class AnalyzerLocked(Exception):
+    pass
+
+
+class StateStore(object):
+    """Analyzer state kept in an SQLite database in WAL mode.
+
+    Every transition is committed on its own, so a crash only loses the
+    transition in progress. An exclusive lock file makes sure that only one
+    analyzer works on a database at a time.
+    """
+
+    def __init__(self, path='state.db'):
+        self.path = path
+        self._lock_file = open(path + '.lock', 'w')
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self._lock_file.close()
+            raise AnalyzerLocked(
+                'Another analyzer is already using %s' % path)
+        self._lock = threading.RLock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+        fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+        self._lock_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get_meta(self, key, default=None):
+        with self._lock:
+            row = self.conn.execute(
+                'SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return default if row is None else row['value']
+
+    def set_meta(self, key, value):
+        with self._lock, self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                (key, value))
+
+    def _sample(self, row):
+        sample = dict(row)
+        sample_id = sample.pop('sample_id')
+        sample.pop('updated_at')
+        sample['is_fasta'] = bool(sample['is_fasta'])
+        sample['is_paired'] = bool(sample['is_paired'])
+        return sample_id, sample
+
+    def get_sample(self, sample_id):
+        with self._lock:
+            row = self.conn.execute(
+                'SELECT * FROM samples WHERE sample_id = ?',
+                (sample_id,)).fetchone()
+        return None if row is None else self._sample(row)[1]
+
+    def samples_with_status(self, status):
+        with self._lock:
+            rows = self.conn.execute(
+                'SELECT * FROM samples WHERE status = ? ORDER BY sample_id',
+                (status,)).fetchall()
+        return [self._sample(row) for row in rows]
+
+    def update_sample(self, sample_id, **fields):
+        """Creates or updates a sample with the given fields."""
+        unknown = set(fields) - set(SAMPLE_FIELDS)
+        if unknown:
+            raise ValueError('Unknown sample fields: ' + ', '.join(unknown))
+        fields['updated_at'] = now()
+        columns = sorted(fields)
+        with self._lock, self.conn:
+            exists = self.conn.execute(
+                'SELECT 1 FROM samples WHERE sample_id = ?',
+                (sample_id,)).fetchone()
+            if exists:
+                self.conn.execute(
+                    'UPDATE samples SET %s WHERE sample_id = ?' % ', '.join(
+                        '%s = ?' % c for c in columns),
+                    [fields[c] for c in columns] + [sample_id])
+            else:
+                fields.setdefault('status', 'new')
+                columns = sorted(fields)
+                self.conn.execute(
+                    'INSERT INTO samples (sample_id, %s) VALUES (?%s)' % (
+                        ', '.join(columns), ', ?' * len(columns)),
+                    [sample_id] + [fields[c] for c in columns])
+            if fields.get('container_request'):
+                self._record_container_request(
+                    fields['container_request'], sample_id, 'fastq2fasta')
+
+    def _record_container_request(self, uuid, sample_id, kind):
+        self.conn.execute(
+            'INSERT OR IGNORE INTO container_requests '
+            '(uuid, sample_id, kind, submitted_at) VALUES (?, ?, ?, ?)',
+            (uuid, sample_id, kind, now()))
+
+    def set_container_request_state(self, uuid, state):
+        with self._lock, self.conn:
+            self.conn.execute(
+                'UPDATE container_requests SET state = ? WHERE uuid = ?',
+                (state, uuid))
+
+    def last_pangenome_run(self):
+        with self._lock:
+            row = self.conn.execute(
+                'SELECT * FROM pangenome_runs ORDER BY id DESC LIMIT 1'
+            ).fetchone()
+        return None if row is None else dict(row)
+
+    def add_pangenome_run(self, container_request, sample_ids=()):
+        """Records a pangenome run and the samples it includes."""
+        with self._lock, self.conn:
+            self._record_container_request(
+                container_request, None, 'pangenome')
+            cursor = self.conn.execute(
+                'INSERT INTO pangenome_runs '
+                '(container_request, status, submitted_at) VALUES (?, ?, ?)',
+                (container_request, 'submitted', now()))
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO pangenome_members (sample_id, run_id) '
+                'VALUES (?, ?)',
+                [(sample_id, cursor.lastrowid) for sample_id in sample_ids])
+
+    def complete_pangenome_run(self, run_id):
+        with self._lock, self.conn:
+            self.conn.execute(
+                'UPDATE pangenome_runs SET status = ?, completed_at = ? '
+                'WHERE id = ?', ('complete', now(), run_id))
+
+    def fail_pangenome_run(self, run_id):
+        """Marks a run as failed so that its samples are pending again."""
+        with self._lock, self.conn:
+            self.conn.execute(
+                'UPDATE pangenome_runs SET status = ?, completed_at = ? '
+                'WHERE id = ?', ('failed', now(), run_id))
+            self.conn.execute(
+                'DELETE FROM pangenome_members WHERE run_id = ?', (run_id,))
+
+    def pending_pangenome_samples(self):
+        """Returns the complete samples that are not in a pangenome run."""
+        with self._lock:
+            rows = self.conn.execute(
+                'SELECT samples.* FROM samples LEFT JOIN pangenome_members '
+                'ON samples.sample_id = pangenome_members.sample_id '
+                'WHERE samples.status = ? AND pangenome_members.run_id IS NULL '
+                'ORDER BY samples.sample_id', ('complete',)).fetchall()
+        return [self._sample(row) for row in rows]
+
+    def unmerged_pangenome_inputs(self, limit=-1):
+        """Returns the complete samples whose current collection is not
+        merged into the pangenome input collection yet."""
+        with self._lock:
+            rows = self.conn.execute(
+                'SELECT samples.* FROM samples LEFT JOIN pangenome_inputs '
+                'ON samples.sample_id = pangenome_inputs.sample_id '
+                'WHERE samples.status = ? AND ('
+                'pangenome_inputs.portable_data_hash IS NULL OR '
+                'pangenome_inputs.portable_data_hash != '
+                'samples.portable_data_hash) '
+                'ORDER BY samples.sample_id LIMIT ?',
+                ('complete', limit)).fetchall()
+        return [self._sample(row) for row in rows]
+
+    def pangenome_inputs(self):
+        """Returns the (sample_id, portable_data_hash) pairs of the samples
+        merged into the pangenome input collection."""
+        with self._lock:
+            rows = self.conn.execute(
+                'SELECT sample_id, portable_data_hash FROM pangenome_inputs '
+                'ORDER BY sample_id').fetchall()
+        return [tuple(row) for row in rows]
+
+    def add_pangenome_inputs(self, samples):
+        """Records (sample_id, portable_data_hash) pairs as merged."""
+        with self._lock, self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO pangenome_inputs '
+                '(sample_id, portable_data_hash) VALUES (?, ?)', samples)
+
+    def import_json(self, path):
+        """Imports the samples and pangenome request of an old state.json.
+
+        Does nothing if the database already has samples.
+        """
+        with self._lock:
+            if self.conn.execute('SELECT 1 FROM samples LIMIT 1').fetchone():
+                return False
+            with open(path) as f:
+                state = json.load(f)
+            for key, value in state.items():
+                if not isinstance(value, dict):
+                    continue
+                sample = {k: v for k, v in value.items()
+                          if k in SAMPLE_FIELDS}
+                self.update_sample(key, **sample)
+            if state.get('last_modified_at'):
+                self.set_meta('last_modified_at', state['last_modified_at'])
+            if state.get('last_pangenome_request'):
+                self.add_pangenome_run(state['last_pangenome_request'])
+                if state.get('last_pangenome_request_status') == 'complete':
+                    self.complete_pangenome_run(
+                        self.last_pangenome_run()['id'])
+        logging.info('Imported %s into %s', path, self.path)
+        return True
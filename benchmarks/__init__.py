@@ -0,0 +1 @@
+"""Benchmarks with synthetic data and a local Arvados stand-in."""
@@ -0,0 +1,243 @@
+import copy
+import hashlib
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+from cborguploader.blockwriter import LocalKeep
+
+# Largest page returned by list calls, like the API server's default
+MAX_PAGE = 1000
+
+PREFIXES = {
+    'collections': '4zz18',
+    'groups': 'j7d0g',
+    'container_requests': 'xvhdp',
+    'containers': 'dz642',
+    'workflows': '7fd4e',
+}
+
+OPERATORS = {
+    '=': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+    '<': lambda a, b: a is not None and a < b,
+    '<=': lambda a, b: a is not None and a <= b,
+    '>': lambda a, b: a is not None and a > b,
+    '>=': lambda a, b: a is not None and a >= b,
+    'in': lambda a, b: a in b,
+    'not in': lambda a, b: a not in b,
+}
+
+
+def portable_data_hash(manifest_text):
+    data = manifest_text.encode('utf-8')
+    return '%s+%d' % (hashlib.md5(data).hexdigest(), len(data))
+
+
+def field(record, name):
+    value = record
+    for part in name.split('.'):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    return value
+
+
+class FakeRequest(object):
+    """Deferred call, executed like a googleapiclient request."""
+
+    def __init__(self, api, name, fn):
+        self.api = api
+        self.name = name
+        self.fn = fn
+
+    def execute(self, num_retries=None):
+        self.api.count(self.name)
+        if self.api.latency:
+            time.sleep(self.api.latency)
+        with self.api.lock:
+            return copy.deepcopy(self.fn())
+
+
+class FakeResource(object):
+
+    def __init__(self, api, kind):
+        self.api = api
+        self.kind = kind
+        self.records = api.records[kind]
+
+    def _request(self, method, fn):
+        return FakeRequest(self.api, '%s.%s' % (self.kind, method), fn)
+
+    def get(self, uuid):
+        def get():
+            if uuid not in self.records:
+                raise KeyError('%s not found' % uuid)
+            return self.records[uuid]
+        return self._request('get', get)
+
+    def create(self, body, ensure_unique_name=False, **kwargs):
+        return self._request(
+            'create', lambda: self.api.create(self.kind, body))
+
+    def update(self, uuid, body, **kwargs):
+        return self._request(
+            'update', lambda: self.api.update(self.kind, uuid, body))
+
+    def list(self, filters=(), order=None, limit=MAX_PAGE, offset=0,
+             select=None, **kwargs):
+        def list_():
+            items = self.api.filter(self.kind, filters)
+            for key in reversed(self._order(order)):
+                attr, _, direction = key.partition(' ')
+                items.sort(key=lambda r: field(r, attr) or '',
+                           reverse=direction == 'desc')
+            page = items[offset:offset + min(limit, MAX_PAGE)]
+            if select:
+                page = [{k: r[k] for k in select if k in r} for r in page]
+            return {'items': page, 'items_available': len(items),
+                    'offset': offset, 'limit': limit}
+        return self._request('list', list_)
+
+    @staticmethod
+    def _order(order):
+        if order is None:
+            return []
+        if isinstance(order, str):
+            return [order]
+        return list(order)
+
+
+class FakeApi(object):
+    """In-process stand-in for the Arvados API and Keep.
+
+    Supports the collections, groups, container requests, containers and
+    workflows calls made by the uploader and the analyzer. Every executed
+    call sleeps for latency seconds and is counted in calls.
+    """
+
+    def __init__(self, latency=0.0, keep_latency=None):
+        self.latency = latency
+        self.keep = LocalKeep(latency if keep_latency is None else keep_latency)
+        # Part of the discovery document read by arvados.collection
+        self._rootDesc = {'defaultCollectionReplication': 2}
+        self.lock = threading.RLock()
+        self.calls = Counter()
+        self.records = {kind: {} for kind in PREFIXES}
+        self._serial = Counter()
+        self._clock = datetime(2020, 1, 1, tzinfo=timezone.utc)
+
+    def count(self, name):
+        with self.lock:
+            self.calls[name] += 1
+
+    def collections(self):
+        return FakeResource(self, 'collections')
+
+    def groups(self):
+        return FakeResource(self, 'groups')
+
+    def container_requests(self):
+        return FakeResource(self, 'container_requests')
+
+    def containers(self):
+        return FakeResource(self, 'containers')
+
+    def workflows(self):
+        return FakeResource(self, 'workflows')
+
+    def _now(self):
+        # A strictly increasing clock keeps modified_at filters meaningful
+        self._clock += timedelta(microseconds=1)
+        return self._clock.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+    def _uuid(self, kind):
+        self._serial[kind] += 1
+        return 'zzzzz-%s-%015d' % (PREFIXES[kind], self._serial[kind])
+
+    def create(self, kind, body):
+        with self.lock:
+            record = dict(copy.deepcopy(body))
+            record['uuid'] = self._uuid(kind)
+            record['created_at'] = record['modified_at'] = self._now()
+            record.setdefault('properties', {})
+            if kind == 'collections':
+                record.setdefault('manifest_text', '')
+                record['portable_data_hash'] = portable_data_hash(
+                    record['manifest_text'])
+            elif kind == 'container_requests':
+                container = self.create('containers', {
+                    'state': 'Queued', 'priority': 1, 'exit_code': None,
+                    'runtime_status': {}})
+                record.setdefault('state', 'Committed')
+                record['container_uuid'] = container['uuid']
+                record['output_uuid'] = None
+            self.records[kind][record['uuid']] = record
+            return record
+
+    def update(self, kind, uuid, body):
+        with self.lock:
+            record = self.records[kind][uuid]
+            record.update(copy.deepcopy(body))
+            record['modified_at'] = self._now()
+            if kind == 'collections':
+                record['portable_data_hash'] = portable_data_hash(
+                    record.get('manifest_text', ''))
+            return record
+
+    def filter(self, kind, filters):
+        records = self.records[kind]
+        candidates = None
+        rest = []
+        for attr, op, value in filters:
+            # uuid lookups are answered from the index like the real server
+            if attr == 'uuid' and op in ('=', 'in') and candidates is None:
+                uuids = [value] if op == '=' else value
+                candidates = [records[u] for u in uuids if u in records]
+            else:
+                rest.append((attr, OPERATORS[op], value))
+        if candidates is None:
+            candidates = records.values()
+        return [r for r in candidates
+                if all(op(field(r, attr), value) for attr, op, value in rest)]
+
+    def complete_containers(self, exit_code=0):
+        """Finishes every queued container and gives its request an output.
+
+        Returns the number of container requests that were completed.
+        """
+        completed = 0
+        with self.lock:
+            for cr in list(self.records['container_requests'].values()):
+                if cr['state'] == 'Final':
+                    continue
+                container = self.records['containers'][cr['container_uuid']]
+                container.update(state='Complete', exit_code=exit_code)
+                output = self.create('collections', {
+                    'name': 'Output of ' + cr['name'],
+                    'owner_uuid': cr['owner_uuid'],
+                    'manifest_text': '. %s 0:0:output.txt\n' % (
+                        'd41d8cd98f00b204e9800998ecf8427e+0')})
+                cr.update(state='Final', output_uuid=output['uuid'],
+                          modified_at=self._now())
+                completed += 1
+        return completed
+
+
+def add_uploads(api, project_uuid, count, paired=True, start=0):
+    """Creates count sample collections as the uploader would."""
+    for i in range(start, start + count):
+        sample_id = 'sample%d' % (i + 1)
+        api.create('collections', {
+            'name': sample_id,
+            'owner_uuid': project_uuid,
+            'manifest_text': '. d41d8cd98f00b204e9800998ecf8427e+0 '
+                             '0:0:reads1.fastq 0:0:reads2.fastq '
+                             '0:0:metadata.yaml\n',
+            'properties': {
+                'sequence_label': sample_id,
+                'upload_app': 'cborguploader',
+                'is_fasta': False,
+                'is_paired': paired,
+            }})
@@ -0,0 +1,66 @@
+import random
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SYNC_PATH = '/api/uploader/sync'
+
+
+class FakePortal(object):
+    """Serves the sync endpoint on localhost in a background thread.
+
+    Every request is delayed by latency seconds and answered with HTTP 503
+    with probability error_rate. Accepted requests are kept in received.
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.received = []
+        self.requests = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        portal = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                status = portal.handle(self.path, body)
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self._thread = threading.Thread(
+            target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d%s' % (self.server.server_port, SYNC_PATH)
+
+    def handle(self, path, body):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.requests += 1
+            if path != SYNC_PATH:
+                return 404
+            if self._random.random() < self.error_rate:
+                return 503
+            self.received.append(dict(urllib.parse.parse_qsl(body.decode())))
+        return 200
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
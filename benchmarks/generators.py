@@ -0,0 +1,97 @@
+import pkg_resources
+import random
+
+COMPLEMENT = str.maketrans('ACGTN', 'TGCAN')
+# Phred+33 quality characters used for synthetic reads
+QUALITIES = 'FGHI'
+
+
+def reference_sequence():
+    """Returns the bundled SARS-CoV-2 reference genome."""
+    lines = pkg_resources.resource_string(
+        'cborguploader', 'SARS-CoV-2-reference.fasta').decode(
+            'utf-8').splitlines()
+    return ''.join(line.strip() for line in lines
+                   if not line.startswith('>')).upper()
+
+
+def reverse_complement(seq):
+    return seq.translate(COMPLEMENT)[::-1]
+
+
+def mutate(seq, rng, substitution_rate=0.001, indel_rate=0.0001):
+    """Returns seq with random substitutions and single base indels."""
+    bases = list(seq)
+    for pos in rng.sample(range(len(bases)),
+                          int(len(bases) * substitution_rate)):
+        bases[pos] = rng.choice('ACGT'.replace(bases[pos], ''))
+    # Indels are applied from the end so positions stay valid
+    for pos in sorted(rng.sample(range(len(bases)),
+                                 int(len(bases) * indel_rate)), reverse=True):
+        if rng.random() < 0.5:
+            del bases[pos]
+        else:
+            bases.insert(pos, rng.choice('ACGT'))
+    return ''.join(bases)
+
+
+def synthetic_genome(rng, reference=None, substitution_rate=0.001,
+                     indel_rate=0.0001):
+    if reference is None:
+        reference = reference_sequence()
+    return mutate(reference, rng, substitution_rate, indel_rate)
+
+
+def write_fasta(path, records, line_width=70):
+    """Writes (label, sequence) pairs to a FASTA file."""
+    with open(path, 'w') as f:
+        for label, seq in records:
+            f.write('>%s\n' % label)
+            for i in range(0, len(seq), line_width):
+                f.write(seq[i:i + line_width])
+                f.write('\n')
+    return path
+
+
+def write_multifasta(path, count, seed=0, substitution_rate=0.001,
+                     indel_rate=0.0001, prefix='synthetic'):
+    """Writes count synthetic genomes named prefix1..prefixN to path."""
+    rng = random.Random(seed)
+    reference = reference_sequence()
+    return write_fasta(path, (
+        ('%s%d' % (prefix, i + 1),
+         mutate(reference, rng, substitution_rate, indel_rate))
+        for i in range(count)))
+
+
+def write_paired_fastq(read1_path, read2_path, depth=100, read_length=150,
+                       insert_size=400, error_rate=0.002, seed=0,
+                       genome=None):
+    """Writes paired reads sampled from a synthetic genome.
+
+    depth is the mean coverage of the genome by both reads. Returns the
+    number of read pairs.
+    """
+    rng = random.Random(seed)
+    if genome is None:
+        genome = synthetic_genome(rng)
+    insert_size = min(insert_size, len(genome))
+    read_length = min(read_length, insert_size)
+    pairs = int(depth * len(genome) / (2 * read_length))
+    # A small pool of quality strings keeps generation fast
+    quality_pool = [''.join(rng.choice(QUALITIES) for _ in range(read_length))
+                    for _ in range(64)]
+    with open(read1_path, 'w') as r1, open(read2_path, 'w') as r2:
+        for n in range(pairs):
+            start = rng.randrange(len(genome) - insert_size + 1)
+            fragment = genome[start:start + insert_size]
+            reads = [fragment[:read_length],
+                     reverse_complement(fragment[-read_length:])]
+            for out, read, mate in zip((r1, r2), reads, (1, 2)):
+                errors = int(rng.random() < error_rate * read_length)
+                if errors:
+                    pos = rng.randrange(read_length)
+                    read = read[:pos] + rng.choice('ACGT') + read[pos + 1:]
+                out.write('@synthetic.%d/%d\n%s\n+\n%s\n' % (
+                    n + 1, mate, read, rng.choice(quality_pool)))
+    return pairs
@@ -0,0 +1,370 @@
+import click as ck
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+from benchmarks.fake_arvados import FakeApi, add_uploads
+from benchmarks.fake_portal import FakePortal
+from benchmarks.generators import (
+    reference_sequence, synthetic_genome, write_multifasta, write_paired_fastq)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SUITES = ['upload', 'validate', 'qc', 'analyzer', 'sync', 'startup']
+# Entry points whose import time is checked by the startup suite
+CLI_MODULES = ['cborguploader.main', 'cborguploader.batch',
+               'cborguploader.multifasta', 'metacon']
+# Dependencies that must only be imported on the code paths using them
+HEAVY_MODULES = ['arvados', 'schema_salad', 'rdflib', 'pyshex', 'Bio',
+                 'pkg_resources']
+IMPORT_TIMER = '''
+import sys, time
+start = time.perf_counter()
+import %s
+print(time.perf_counter() - start)
+print(' '.join(m for m in %r if m in sys.modules))
+'''
+
+
+def measure(fn, repeat=3):
+    """Runs fn repeat times and returns the timings in seconds."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return {'min': min(times), 'median': statistics.median(times),
+            'repeat': repeat}
+
+
+def result(name, params, seconds, **metrics):
+    return dict(name=name, params=params, seconds=seconds, **metrics)
+
+
+def throughput(nbytes, seconds):
+    return round(nbytes / seconds['median'] / (1 << 20), 2)
+
+
+def generate_reads(workdir, depth, seed):
+    read1 = os.path.join(workdir, 'reads1.fastq')
+    read2 = os.path.join(workdir, 'reads2.fastq')
+    if not os.path.exists(read1):
+        write_paired_fastq(read1, read2, depth=depth, seed=seed)
+    return read1, read2
+
+
+def bench_upload(workdir, depth, keep_latency, put_threads, block_size,
+                 repeat, seed):
+    import arvados.collection
+    from cborguploader.blockwriter import BlockWriter
+    from cborguploader.main import upload_fastq
+
+    read1, read2 = generate_reads(workdir, depth, seed)
+    size = os.path.getsize(read1)
+    results = []
+    for threads in put_threads:
+        def upload():
+            api = FakeApi(keep_latency=keep_latency)
+            writer = BlockWriter(api.keep, threads, block_size)
+            upload_fastq(arvados.collection.Collection(
+                api_client=api, keep_client=api.keep), read1,
+                'reads1.fastq', writer)
+        seconds = measure(upload, repeat)
+        results.append(result(
+            'upload_fastq',
+            {'depth': depth, 'bytes': size, 'put_threads': threads,
+             'block_size': block_size, 'keep_latency': keep_latency},
+            seconds, mib_per_s=throughput(size, seconds)))
+    return results
+
+
+def bench_validate(workdir, depth, genomes, repeat, seed):
+    from cborguploader.main import validate_fasta, validate_fastq
+
+    read1, read2 = generate_reads(workdir, depth, seed)
+    fasta = os.path.join(workdir, 'genomes.fasta')
+    if not os.path.exists(fasta):
+        write_multifasta(fasta, genomes, seed=seed)
+    results = []
+    for name, fn, path in [('validate_fastq', validate_fastq, read1),
+                           ('validate_fasta', validate_fasta, fasta)]:
+        size = os.path.getsize(path)
+        seconds = measure(lambda: fn(path), repeat)
+        results.append(result(
+            name, {'bytes': size}, seconds,
+            mib_per_s=throughput(size, seconds)))
+    return results
+
+
+def bench_qc(genomes, substitution_rates, seed):
+    from cborguploader.qc_fasta import qc_fasta
+
+    reference = reference_sequence()
+    results = []
+    for rate in substitution_rates:
+        rng = random.Random(seed)
+        latencies = []
+        passed = 0
+        for i in range(genomes):
+            fasta = '>synthetic%d\n%s\n' % (
+                i + 1, synthetic_genome(rng, reference, rate))
+            start = time.perf_counter()
+            try:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    qc_fasta(io.StringIO(fasta))
+                passed += 1
+            except ValueError:
+                pass
+            latencies.append(time.perf_counter() - start)
+        results.append(result(
+            'qc_fasta', {'genomes': genomes, 'substitution_rate': rate},
+            {'min': min(latencies), 'median': statistics.median(latencies),
+             'repeat': genomes},
+            passed=passed))
+    return results
+
+
+def analyzer_module():
+    # The analyzer is a script directory with sibling imports
+    path = os.path.join(ROOT, 'analyzer')
+    if path not in sys.path:
+        sys.path.insert(0, path)
+    import main as analyzer
+    import state
+    return analyzer, state
+
+
+def bench_analyzer(workdir, sizes, latency, submit_jobs):
+    analyzer, state = analyzer_module()
+    results = []
+    for size in sizes:
+        api = FakeApi(latency)
+        uploader_project = api.create('groups', {'name': 'uploads'})['uuid']
+        workflows_project = api.create('groups', {'name': 'workflows'})['uuid']
+        workflow = api.create('workflows', {'definition': '{}'})['uuid']
+        result_col = api.create('collections', {'name': 'pangenome'})['uuid']
+        add_uploads(api, uploader_project, size)
+        db = os.path.join(workdir, 'state-%d.db' % size)
+        for path in (db, db + '-wal', db + '-shm'):
+            if os.path.exists(path):
+                os.remove(path)
+        ticks = [('discover_submit', None), ('poll', None),
+                 ('finalize', api.complete_containers), ('idle', None)]
+        with state.StateStore(db) as store:
+            for tick, prepare in ticks:
+                if prepare is not None:
+                    prepare()
+                calls = sum(api.calls.values())
+                start = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    analyzer.run(
+                        api, store, uploader_project, workflows_project,
+                        workflow, workflow, result_col, submit_jobs)
+                elapsed = time.perf_counter() - start
+                results.append(result(
+                    'analyzer_tick',
+                    {'collections': size, 'tick': tick,
+                     'api_latency': latency, 'submit_jobs': submit_jobs},
+                    {'min': elapsed, 'median': elapsed, 'repeat': 1},
+                    api_calls=sum(api.calls.values()) - calls))
+    return results
+
+
+def bench_sync(workdir, events, latency, error_rate, seed):
+    from cborguploader.sync import SyncOutbox, flush, make_session
+
+    results = []
+    with FakePortal(latency, error_rate, seed) as portal:
+        path = os.path.join(workdir, 'sync-outbox.db')
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+        with SyncOutbox(path) as outbox:
+            start = time.perf_counter()
+            for i in range(events):
+                outbox.add(portal.url, 'col%d' % i,
+                           {'col_uuid': 'col%d' % i, 'status': 'uploaded'})
+            enqueued = time.perf_counter() - start
+            flush(outbox, make_session())
+            elapsed = time.perf_counter() - start - enqueued
+            delivered = len(portal.received)
+        params = {'events': events, 'portal_latency': latency,
+                  'error_rate': error_rate}
+        results.append(result(
+            'sync_enqueue', params,
+            {'min': enqueued, 'median': enqueued, 'repeat': 1}))
+        results.append(result(
+            'sync_flush', params,
+            {'min': elapsed, 'median': elapsed, 'repeat': 1},
+            delivered=delivered, requests=portal.requests))
+    return results
+
+
+def import_time(module, repeat=3):
+    """Times the import of module in fresh interpreters.
+
+    Returns the timings and the heavy modules loaded by the import.
+    """
+    times = []
+    for _ in range(repeat):
+        out = subprocess.check_output(
+            [sys.executable, '-c', IMPORT_TIMER % (module, HEAVY_MODULES)],
+            cwd=ROOT).decode('utf-8').split('\n')
+        times.append(float(out[0]))
+    return ({'min': min(times), 'median': statistics.median(times),
+             'repeat': repeat}, out[1].split())
+
+
+def bench_startup(repeat):
+    results = []
+    for module in CLI_MODULES:
+        seconds, heavy = import_time(module, repeat)
+        results.append(result(
+            'import', {'module': module}, seconds, heavy_modules=heavy))
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+            stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def int_list(value):
+    return [int(v) for v in value.split(',') if v]
+
+
+def float_list(value):
+    return [float(v) for v in value.split(',') if v]
+
+
+@ck.group()
+def main():
+    """Benchmarks for the uploader and the analyzer."""
+
+
+@main.command()
+@ck.option('--suites', '-s', default=','.join(SUITES), help='Comma separated suites to run: ' + ', '.join(SUITES))
+@ck.option('--sizes', default='1000,10000,100000', help='Numbers of collections for the analyzer suite')
+@ck.option('--depth', default=100, help='Coverage of the synthetic paired reads')
+@ck.option('--genomes', default=200, help='Number of synthetic genomes for FASTA validation')
+@ck.option('--qc-genomes', default=5, help='Number of synthetic genomes per substitution rate for QC')
+@ck.option('--substitution-rates', default='0.001,0.1,0.3', help='Substitution rates of the genomes for QC')
+@ck.option('--api-latency', default=0.0, help='Seconds added to every fake API call')
+@ck.option('--keep-latency', default=0.005, help='Seconds added to every fake Keep put')
+@ck.option('--put-threads', default='1,4,8', help='Numbers of Keep put workers to compare')
+@ck.option('--block-size', default=1, help='Keep block size in MiB for the upload suite')
+@ck.option('--submit-jobs', default=4, help='Concurrent submissions in the analyzer suite')
+@ck.option('--sync-events', default=500, help='Number of web sync events for the sync suite')
+@ck.option('--portal-latency', default=0.01, help='Seconds added to every request of the local portal')
+@ck.option('--portal-error-rate', default=0.0, help='Fraction of portal requests answered with HTTP 503')
+@ck.option('--repeat', '-r', default=3, help='Repetitions of each timing')
+@ck.option('--seed', default=0, help='Seed of the synthetic data')
+@ck.option('--workdir', default=None, help='Directory for generated data, a temporary one by default')
+@ck.option('--output', '-o', default=None, help='JSON results file, stdout by default')
+def run(suites, sizes, depth, genomes, qc_genomes, substitution_rates,
+        api_latency, keep_latency, put_threads, block_size, submit_jobs,
+        sync_events, portal_latency, portal_error_rate, repeat, seed, workdir,
+        output):
+    """Runs the benchmark suites and writes the timings as JSON."""
+    suites = [s for s in suites.split(',') if s]
+    unknown = set(suites) - set(SUITES)
+    if unknown:
+        raise ck.UsageError('Unknown suites: ' + ', '.join(sorted(unknown)))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        workdir = workdir or tmp_dir
+        os.makedirs(workdir, exist_ok=True)
+        results = []
+        if 'upload' in suites:
+            results += bench_upload(
+                workdir, depth, keep_latency, int_list(put_threads),
+                block_size << 20, repeat, seed)
+        if 'validate' in suites:
+            results += bench_validate(workdir, depth, genomes, repeat, seed)
+        if 'qc' in suites:
+            results += bench_qc(
+                qc_genomes, float_list(substitution_rates), seed)
+        if 'analyzer' in suites:
+            results += bench_analyzer(
+                workdir, int_list(sizes), api_latency, submit_jobs)
+        if 'sync' in suites:
+            results += bench_sync(
+                workdir, sync_events, portal_latency, portal_error_rate,
+                seed)
+        if 'startup' in suites:
+            results += bench_startup(repeat)
+    report = {
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+    if output is None:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+def result_key(r):
+    return r['name'], json.dumps(r['params'], sort_keys=True)
+
+
+@main.command()
+@ck.argument('baseline')
+@ck.argument('current')
+@ck.option('--threshold', '-t', default=0.1, help='Relative slowdown of the median reported as a regression')
+def compare(baseline, current, threshold):
+    """Compares two result files and fails on regressions."""
+    with open(baseline) as f:
+        before = {result_key(r): r for r in json.load(f)['results']}
+    with open(current) as f:
+        after = json.load(f)['results']
+    regressions = 0
+    for r in after:
+        old = before.get(result_key(r))
+        if old is None:
+            continue
+        ratio = r['seconds']['median'] / max(old['seconds']['median'], 1e-9)
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = '\tREGRESSION'
+            regressions += 1
+        print('%s\t%s\t%.4fs -> %.4fs\t%.2fx%s' % (
+            r['name'], json.dumps(r['params'], sort_keys=True),
+            old['seconds']['median'], r['seconds']['median'], ratio, flag))
+    if regressions:
+        sys.exit(1)
+
+
+@main.command()
+@ck.option('--budget', '-b', default=0.3, help='Maximum median import time of an entry point in seconds')
+@ck.option('--repeat', '-r', default=5, help='Number of timed imports per entry point')
+def startup(budget, repeat):
+    """Fails if an entry point imports slowly or loads heavy modules."""
+    failures = 0
+    for r in bench_startup(repeat):
+        problems = []
+        if r['seconds']['median'] > budget:
+            problems.append('over budget')
+        if r['heavy_modules']:
+            problems.append('imports ' + ', '.join(r['heavy_modules']))
+        failures += bool(problems)
+        print('%s\t%.4fs\t%s' % (
+            r['params']['module'], r['seconds']['median'],
+            '; '.join(problems) or 'ok'))
+    if failures:
+        sys.exit(1)
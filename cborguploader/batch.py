@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+import click as ck
+import csv
+import os
+import sys
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from cborguploader.blockwriter import DEFAULT_PUT_THREADS
+from cborguploader.main import api_client, upload_sample
+from cborguploader.manifest import MANIFEST_COLUMNS
+from cborguploader.metrics import count, reporting
+from cborguploader.sync import background_sync
+
+
+# File names looked up inside each sample folder of a batch directory
+SAMPLE_FILES = {
+    'metadata': ['metadata.yaml', 'metadata.yml'],
+    'fasta': ['sequence.fasta', 'sequence.fa', 'sequence.fasta.gz'],
+    'read1': ['reads1.fastq', 'reads_1.fastq', 'reads1.fastq.gz',
+              'reads_1.fastq.gz', 'reads1.fastq.zst'],
+    'read2': ['reads2.fastq', 'reads_2.fastq', 'reads2.fastq.gz',
+              'reads_2.fastq.gz', 'reads2.fastq.zst'],
+}
+
+
+def read_sample_dirs(path):
+    samples = []
+    for name in sorted(os.listdir(path)):
+        sample_dir = os.path.join(path, name)
+        if not os.path.isdir(sample_dir):
+            continue
+        sample = {'sample': name}
+        for key, candidates in SAMPLE_FILES.items():
+            sample[key] = None
+            for filename in candidates:
+                if os.path.exists(os.path.join(sample_dir, filename)):
+                    sample[key] = os.path.join(sample_dir, filename)
+                    break
+        samples.append(sample)
+    return samples
+
+
+def read_manifest(path):
+    """Reads a TSV/CSV manifest with the columns in MANIFEST_COLUMNS.
+
+    Relative file paths are resolved against the manifest location.
+    """
+    if os.path.isdir(path):
+        return read_sample_dirs(path)
+    base_dir = os.path.dirname(os.path.abspath(path))
+    delimiter = ',' if path.endswith('.csv') else '\t'
+    samples = []
+    with open(path, newline='') as f:
+        reader = csv.DictReader(f, delimiter=delimiter)
+        missing = {'metadata'} - set(reader.fieldnames or [])
+        if missing:
+            raise ck.UsageError(
+                'Manifest is missing columns: ' + ', '.join(sorted(missing)))
+        for i, row in enumerate(reader):
+            sample = {'sample': row.get('sample') or 'row%d' % (i + 1)}
+            for key in MANIFEST_COLUMNS[1:]:
+                value = (row.get(key) or '').strip()
+                sample[key] = os.path.join(base_dir, value) if value else None
+            samples.append(sample)
+    return samples
+
+
+def upload_one(api, uploader_project, sample, no_sync, force, put_threads):
+    try:
+        response = upload_sample(
+            api, uploader_project, sample['metadata'], sample['fasta'],
+            sample['read1'], sample['read2'], no_sync, force, put_threads)
+        count('samples_uploaded')
+        return sample['sample'], 'uploaded', response['uuid']
+    except Exception as e:
+        logging.exception('Upload of %s failed', sample['sample'])
+        count('samples_failed')
+        return sample['sample'], 'failed', str(e)
+
+
+def print_results(results, out=sys.stdout):
+    width = max([len('sample')] + [len(r[0]) for r in results])
+    out.write('%-*s\t%-8s\t%s\n' % (width, 'sample', 'status', 'result'))
+    for sample, status, result in results:
+        out.write('%-*s\t%-8s\t%s\n' % (width, sample, status, result))
+
+
+@ck.command()
+@ck.option(
+    '--uploader-project', '-up', required=True,
+    help='COVID19 FASTA/FASTQ sequences project uuid')
+@ck.option(
+    '--manifest', '-mf', required=True,
+    help='TSV/CSV manifest with sample, metadata, fasta, read1 and read2 '
+    'columns or a directory with one folder per sample')
+@ck.option('--jobs', '-j', default=4, help='Number of concurrent uploads')
+@ck.option('--no-sync', '-ns', is_flag=True)
+@ck.option('--force', '-f', is_flag=True, help='Upload samples even if the same files were already uploaded to the project')
+@ck.option('--put-threads', '-pt', default=DEFAULT_PUT_THREADS, help='Number of concurrent Keep block uploads per sample')
+@ck.option('--metrics-out', default=None, help='Write stage timings and counters to this file, as a Prometheus textfile if it ends with .prom and JSON otherwise')
+@ck.option('--profile', default=None, help='Write cProfile statistics of the main thread to this file')
+def main(uploader_project, manifest, jobs, no_sync, force, put_threads,
+         metrics_out, profile):
+    samples = read_manifest(manifest)
+    if not samples:
+        raise ck.UsageError('No samples found in ' + manifest)
+    api = api_client(thread_safe=True)
+    with reporting(metrics_out, profile), background_sync(not no_sync), \
+            ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = list(executor.map(
+            lambda sample: upload_one(
+                api, uploader_project, sample, no_sync, force, put_threads),
+            samples))
+    print_results(results)
+    failed = sum(1 for r in results if r[1] != 'uploaded')
+    print(f'Uploaded {len(results) - failed} of {len(results)} samples')
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
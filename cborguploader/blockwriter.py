@@ -0,0 +1,216 @@
+import contextlib
+import hashlib
+import mmap
+import os
+import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from cborguploader.metrics import count, span
+
+# Keep stores data in blocks of at most 64 MiB
+KEEP_BLOCK_SIZE = 1 << 26
+DEFAULT_PUT_THREADS = 4
+# Size of the slices handed to validators
+VALIDATE_CHUNK_SIZE = 1 << 20
+
+EMPTY_LOCATOR = 'd41d8cd98f00b204e9800998ecf8427e+0'
+
+
+class Throughput(object):
+    """Reports the upload rate of a file on stderr."""
+
+    def __init__(self, name, out=sys.stderr, interval=1.0):
+        self.name = name
+        self.out = out
+        self.interval = interval
+        self.bytes = 0
+        self.start = time.monotonic()
+        self._last_report = self.start
+        self._lock = threading.Lock()
+
+    def rate(self):
+        elapsed = max(time.monotonic() - self.start, 1e-9)
+        return self.bytes / elapsed / (1 << 20)
+
+    def update(self, nbytes):
+        with self._lock:
+            self.bytes += nbytes
+            now = time.monotonic()
+            if self.out is not None and now - self._last_report >= self.interval:
+                self._last_report = now
+                self.out.write('\r%s: %d MiB, %.1f MiB/s' % (
+                    self.name, self.bytes >> 20, self.rate()))
+                self.out.flush()
+
+    def finish(self):
+        if self.out is not None:
+            self.out.write('\r%s: %d MiB in %.1f s, %.1f MiB/s\n' % (
+                self.name, self.bytes >> 20, time.monotonic() - self.start,
+                self.rate()))
+            self.out.flush()
+
+
+def read_blocks(source, block_size):
+    """Yields block_size chunks of a readable file object.
+
+    Streams such as decompressors may return short reads, so reads are
+    repeated until a block is full.
+    """
+    block = source.read(block_size)
+    while block:
+        while len(block) < block_size:
+            more = source.read(block_size - len(block))
+            if not more:
+                break
+            block += more
+        yield block
+        block = source.read(block_size)
+
+
+@contextlib.contextmanager
+def mapped(filename):
+    """Maps a file into memory and yields a read-only memoryview of it.
+
+    Slices of the view share the page cache instead of copying the data.
+    """
+    if os.path.getsize(filename) == 0:
+        yield memoryview(b'')
+        return
+    with open(filename, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        yield memoryview(mm)
+    finally:
+        try:
+            mm.close()
+        except BufferError:
+            # Slices are still referenced, e.g. by a traceback; the mapping
+            # is closed when they are freed
+            pass
+
+
+class BlockWriter(object):
+    """Writes files to Keep as full blocks using a pool of put workers.
+
+    keep is anything with a put(data, copies=None) method returning a
+    locator, e.g. arvados.keep.KeepClient or a local stand-in. Plain files
+    are memory mapped and their blocks are passed around as memoryview
+    slices. Clients that only take bytes, like KeepClient, get a copy of
+    each block when it is sent, so at most threads blocks are copied at a
+    time. Clients with accepts_buffers set get the slices themselves.
+    Blocks of streams such as decompressors are read into memory, at most
+    threads + 1 of them per file.
+    """
+
+    def __init__(self, keep, threads=DEFAULT_PUT_THREADS,
+                 block_size=KEEP_BLOCK_SIZE, copies=None):
+        if not 0 < block_size <= KEEP_BLOCK_SIZE:
+            raise ValueError('Block size must be between 1 byte and 64 MiB')
+        self.keep = keep
+        self.threads = threads
+        self.block_size = block_size
+        self.copies = copies
+
+    def _put(self, block, throughput):
+        if (isinstance(block, memoryview)
+                and not getattr(self.keep, 'accepts_buffers', False)):
+            block = block.tobytes()
+        with span('keep_put'):
+            locator = self.keep.put(block, copies=self.copies)
+        count('keep_put_bytes', len(block))
+        throughput.update(len(block))
+        return locator
+
+    def write(self, source, name, validator=None, out=sys.stderr, resume=(),
+              committed=None):
+        """Uploads source and returns a manifest stream for it as name.
+
+        If validator is given it is called with the data of every block
+        before the block is queued for upload. resume holds the locators of
+        the first blocks of source if they were already written by an
+        interrupted upload; those blocks are only read and validated again.
+        committed, if given, is called with the locators and the size of
+        the leading blocks that are in Keep whenever more of them are.
+        """
+        throughput = Throughput(name, out)
+        # Bound the number of blocks held in memory
+        slots = threading.BoundedSemaphore(self.threads + 1)
+        resume = list(resume)
+        futures = []
+        sizes = []
+        done_locators = []
+        done_size = 0
+        with contextlib.ExitStack() as stack:
+            if isinstance(source, str):
+                data = stack.enter_context(mapped(source))
+                blocks = (data[offset:offset + self.block_size]
+                          for offset in range(0, len(data), self.block_size))
+            else:
+                blocks = read_blocks(source, self.block_size)
+            # The executor is shut down before the mapping is closed, so
+            # no block is used after it
+            executor = stack.enter_context(
+                ThreadPoolExecutor(max_workers=self.threads))
+            try:
+                for block in blocks:
+                    if validator is not None:
+                        for i in range(0, len(block), VALIDATE_CHUNK_SIZE):
+                            validator(block[i:i + VALIDATE_CHUNK_SIZE])
+                    if len(futures) < len(resume):
+                        future = Future()
+                        future.set_result(resume[len(futures)])
+                    else:
+                        slots.acquire()
+                        future = executor.submit(self._put, block, throughput)
+                        future.add_done_callback(lambda f: slots.release())
+                    futures.append(future)
+                    sizes.append(len(block))
+                    if committed is None:
+                        continue
+                    before = n = len(done_locators)
+                    while (n < len(futures) and futures[n].done()
+                           and futures[n].exception() is None):
+                        done_locators.append(futures[n].result())
+                        done_size += sizes[n]
+                        n += 1
+                    if n > max(before, len(resume)):
+                        committed(list(done_locators), done_size)
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+            locators = [future.result() for future in futures]
+        throughput.finish()
+        size = sum(sizes)
+        if committed is not None:
+            committed(locators, size)
+        if not locators:
+            locators = [EMPTY_LOCATOR]
+        return '. %s 0:%d:%s\n' % (
+            ' '.join(locators), size, name.replace(' ', '\\040'))
+
+
+class LocalKeep(object):
+    """In-memory Keep stand-in with optional latency per put."""
+
+    accepts_buffers = True
+    # Read by the block manager of arvados.collection
+    num_prefetch_threads = 0
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.blocks = {}
+        self._lock = threading.Lock()
+
+    def put(self, data, copies=None):
+        if self.latency:
+            time.sleep(self.latency)
+        locator = '%s+%d' % (hashlib.md5(data).hexdigest(), len(data))
+        with self._lock:
+            self.blocks[locator] = bytes(data)
+        return locator
+
+    def get(self, locator):
+        return self.blocks[locator.split('+A')[0]]
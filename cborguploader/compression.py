@@ -0,0 +1,137 @@
+import contextlib
+import gzip
+import io
+import zlib
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+COMPRESSION_SUFFIXES = {
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+
+# Compressed formats that are uploaded as they are. The FASTQ workflows
+# read gzip (and bgzip, which is multi-member gzip) natively but not zstd.
+UPLOAD_COMPRESSED = {'gzip'}
+
+
+def detect_compression(filename):
+    """Returns 'gzip', 'zstd' or None by looking at the file magic."""
+    with open(filename, 'rb') as f:
+        head = f.read(4)
+    if head.startswith(GZIP_MAGIC):
+        return 'gzip'
+    if head.startswith(ZSTD_MAGIC):
+        return 'zstd'
+    return None
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ValueError(
+            'Reading zstd compressed files requires the zstandard package')
+    return zstandard
+
+
+def open_binary(filename):
+    """Opens a file for reading, decompressing it if needed."""
+    compression = detect_compression(filename)
+    if compression == 'gzip':
+        return gzip.open(filename, 'rb')
+    if compression == 'zstd':
+        dctx = _zstandard().ZstdDecompressor()
+        return dctx.stream_reader(open(filename, 'rb'), closefd=True)
+    return open(filename, 'rb')
+
+
+def open_text(filename):
+    return io.TextIOWrapper(open_binary(filename), encoding='utf-8')
+
+
+@contextlib.contextmanager
+def truncation_errors(filename):
+    """Reports a compressed file that ends within a member as ValueError."""
+    try:
+        yield
+    except EOFError:
+        raise ValueError('Compressed file %s is truncated' % filename)
+
+
+class _GzipStream(object):
+
+    def __init__(self):
+        self._dec = zlib.decompressobj(31)
+        self._in_member = False
+
+    def decompress(self, data):
+        out = []
+        while data:
+            self._in_member = True
+            out.append(self._dec.decompress(data))
+            if not self._dec.eof:
+                break
+            # bgzip files are a series of gzip members
+            data = self._dec.unused_data
+            self._dec = zlib.decompressobj(31)
+            self._in_member = False
+        return b''.join(out)
+
+    def finish(self):
+        if self._in_member:
+            raise ValueError('Compressed file is truncated')
+
+
+class _ZstdStream(object):
+
+    def __init__(self):
+        self._dctx = _zstandard().ZstdDecompressor()
+        self._dec = self._dctx.decompressobj()
+        self._in_frame = False
+
+    def decompress(self, data):
+        out = []
+        while data:
+            self._in_frame = True
+            out.append(self._dec.decompress(data))
+            if getattr(self._dec, 'eof', False):
+                self._in_frame = False
+            data = getattr(self._dec, 'unused_data', b'')
+            if not data:
+                break
+            self._dec = self._dctx.decompressobj()
+        return b''.join(out)
+
+    def finish(self):
+        # Older zstandard versions do not report the end of a frame
+        if self._in_frame and hasattr(self._dec, 'eof'):
+            raise ValueError('Compressed file is truncated')
+
+
+class Decompressing(object):
+    """Chunk callback that passes the decompressed data on to callback.
+
+    finish() must be called after the last chunk and raises ValueError if
+    the data ended within a compressed member.
+    """
+
+    def __init__(self, callback, compression):
+        self.callback = callback
+        self.stream = _GzipStream() if compression == 'gzip' else _ZstdStream()
+
+    def __call__(self, chunk):
+        data = self.stream.decompress(chunk)
+        if data:
+            self.callback(data)
+
+    def finish(self):
+        self.stream.finish()
+
+
+def decompressing(callback, compression):
+    """Wraps a chunk callback so that it receives decompressed data."""
+    if compression is None:
+        return callback
+    return Decompressing(callback, compression)
@@ -0,0 +1,79 @@
+import logging
+import threading
+
+# Bytes at the start of a file used to detect its format
+SNIFF_SIZE = 4096
+
+FASTA_MIME = "text/fasta"
+FASTQ_MIME = "text/fastq"
+
+FASTA_BASES = b"acgtnACGTN"
+FASTQ_QUALITIES = bytes(range(ord("!"), ord("i") + 1))
+
+_detector = None
+_detector_loaded = False
+_detector_lock = threading.Lock()
+
+
+def _load_detector():
+    """Returns a libmagic detector for the compiled formats database.
+
+    Returns None if python-magic or libmagic is not available.
+    """
+    try:
+        import magic
+        import pkg_resources
+    except ImportError:
+        return None
+    try:
+        return magic.Magic(
+            magic_file=pkg_resources.resource_filename(
+                __name__, "validation/formats.mgc"),
+            uncompress=False, mime=True)
+    except Exception as e:
+        logging.warning("Using the built-in format sniffer: %s", e)
+        return None
+
+
+def _only(line, alphabet):
+    return not line.rstrip(b"\r").translate(None, alphabet)
+
+
+def sniff_format(head):
+    """Detects FASTA and FASTQ from the start of a file without libmagic.
+
+    Follows the rules in validation/formats. The last line of head may be
+    cut short, so it is only checked as a prefix.
+    """
+    lines = head.split(b"\n")
+    if len(lines) > 1 and lines[-1] == b"":
+        lines.pop()
+    if len(lines) < 2:
+        return None
+    if head.startswith(b">") and len(lines[0].rstrip(b"\r")) > 1:
+        if lines[1] and all(_only(line, FASTA_BASES) for line in lines[1:]):
+            return FASTA_MIME
+    elif head.startswith(b"@") and len(lines[0]) > 1:
+        if (_only(lines[1], FASTA_BASES)
+                and (len(lines) < 3 or lines[2].startswith(b"+"))
+                and (len(lines) < 4 or _only(lines[3], FASTQ_QUALITIES))):
+            return FASTQ_MIME
+    return None
+
+
+def detect_format(head):
+    """Returns the MIME type of a sequence file from its first bytes.
+
+    The compiled magic database is loaded once per process and shared, the
+    built-in sniffer is used where libmagic is not installed.
+    """
+    global _detector, _detector_loaded
+    if isinstance(head, str):
+        head = head.encode("utf-8")
+    with _detector_lock:
+        if not _detector_loaded:
+            _detector = _load_detector()
+            _detector_loaded = True
+        if _detector is not None:
+            return _detector.from_buffer(head).lower()
+    return sniff_format(head)
@@ -1,144 +1,424 @@
 #!/usr/bin/env python
 import click as ck
-import arvados
 import os
-import gzip
-from Bio import SeqIO
 import urllib
 import getpass
 import json
 import yaml
 import socket
-import pkg_resources
-import schema_salad.schema
-import schema_salad.ref_resolver
-import schema_salad.jsonld_context
-import traceback
-from rdflib import Graph, Namespace
-from pyshex.evaluate import evaluate
+import sys
 import logging
-import requests
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from cborguploader.blockwriter import (
+    BlockWriter, DEFAULT_PUT_THREADS, KEEP_BLOCK_SIZE)
+from cborguploader.compression import (
+    COMPRESSION_SUFFIXES, UPLOAD_COMPRESSED, decompressing, detect_compression,
+    open_binary, truncation_errors)
+from cborguploader.qc_fasta import FastaChecker
+from cborguploader.qc_fastq import FastqChecker
+from cborguploader.metrics import reporting, span, timed
+from cborguploader.qc_metadata import qc_metadata
+from cborguploader.resume import (
+    UploadCheckpoint, content_digest, find_existing, sample_key)
+from cborguploader.sync import background_sync, enqueue
 
 
 ARVADOS_API_HOST = os.environ.get('ARVADOS_API_HOST', 'cborg.cbrc.kaust.edu.sa')
 ARVADOS_API_TOKEN = os.environ.get('ARVADOS_API_TOKEN', '')
 UPLOADER_URL = os.environ.get('UPLOADER_URL', 'https://upload.cborg.cbrc.kaust.edu.sa')
 
-def upload_file(col, filename_local, filename_remote):
-    lf = open(filename_local, 'rb')
-    with col.open(filename_remote, "wb") as f:
+def keep_client(api):
+    keep = getattr(api, 'keep', None)
+    if keep is None:
+        import arvados.keep
+        keep = arvados.keep.KeepClient(api_client=api, num_retries=5)
+    return keep
+
+@timed('upload_file')
+def upload_file(col, filename_local, filename_remote, validator=None,
+                keep_compressed=False, writer=None, resume=(), committed=None):
+    """Copies a local file into the collection.
+
+    If validator is given it is called with every chunk that is uploaded,
+    so the file is validated in the same pass. Compressed files are kept
+    compressed if keep_compressed is set and the workflows can read the
+    format, otherwise they are decompressed while uploading. With a
+    BlockWriter the file is written as full Keep blocks by its put
+    workers, and resume and committed are passed to BlockWriter.write to
+    continue an interrupted upload. Returns the name of the file in the
+    collection.
+    """
+    compression = detect_compression(filename_local)
+    stream_end = None
+    if keep_compressed and compression in UPLOAD_COMPRESSED:
+        filename_remote += COMPRESSION_SUFFIXES[compression]
+        if validator is not None:
+            validator = decompressing(validator, compression)
+            stream_end = validator.finish
+        lf = None
+    elif compression is not None:
+        lf = open_binary(filename_local)
+    else:
+        lf = None
+    if writer is not None:
+        try:
+            with truncation_errors(filename_local):
+                stream = writer.write(
+                    filename_local if lf is None else lf, filename_remote,
+                    validator, resume=resume, committed=committed)
+        finally:
+            if lf is not None:
+                lf.close()
+        if stream_end is not None:
+            stream_end()
+        import arvados.collection
+        # The stream uses the clients of the collection, it would create
+        # its own from the environment to look up the replication
+        src = arvados.collection.Collection(
+            stream, api_client=col._my_api(), keep_client=writer.keep)
+        col.copy(filename_remote, filename_remote, source_collection=src,
+                 overwrite=True)
+        return filename_remote
+    if lf is None:
+        lf = open(filename_local, 'rb')
+    with col.open(filename_remote, "wb") as f, \
+            truncation_errors(filename_local):
         r = lf.read(65536)
         while r:
+            if validator is not None:
+                validator(r)
             f.write(r)
             r = lf.read(65536)
     lf.close()
+    if stream_end is not None:
+        stream_end()
+    return filename_remote
+
+class UploadCancelled(ValueError):
+    """Raised in an upload when another file of the sample failed."""
+
+
+def cancellable(validator, cancelled):
+    """Wraps a validator so that the upload stops once cancelled is set."""
+    if cancelled is None:
+        return validator
+    def check(chunk):
+        if cancelled.is_set():
+            raise UploadCancelled('Upload cancelled')
+        if validator is not None:
+            validator(chunk)
+    return check
 
 def validate_fastq(fastq_file):
-    with open(fastq_file, 'r') as f:
-        for record in SeqIO.parse(f, 'fastq'):
-            pass
+    checker = FastqChecker()
+    with open_binary(fastq_file) as f, truncation_errors(fastq_file):
+        r = f.read(1 << 20)
+        while r:
+            checker.feed(r)
+            r = f.read(1 << 20)
+    checker.finish()
     return True
 
+def upload_fastq(col, fastq_file, filename_remote, writer=None,
+                 cancelled=None, resume=(), committed=None):
+    """Validates and uploads a FASTQ file in a single pass.
+
+    Returns the name of the file in the collection and the read statistics.
+    """
+    checker = FastqChecker()
+    filename_remote = upload_file(
+        col, fastq_file, filename_remote,
+        cancellable(checker.feed, cancelled), keep_compressed=True,
+        writer=writer, resume=resume, committed=committed)
+    return filename_remote, checker.finish()
+
 def validate_fasta(fasta_file):
-    with open(fasta_file, 'r') as f:
-        for record in SeqIO.parse(f, 'fasta'):
-            pass
+    checker = FastaChecker()
+    with open_binary(fasta_file) as f, truncation_errors(fasta_file):
+        r = f.read(1 << 20)
+        while r:
+            checker.feed(r)
+            r = f.read(1 << 20)
+    checker.finish()
     return True
 
+def upload_fasta(col, fasta_file, writer=None, cancelled=None, resume=(),
+                 committed=None):
+    """Validates and uploads a FASTA file in a single pass."""
+    checker = FastaChecker()
+    filename_remote = upload_file(
+        col, fasta_file, 'sequence.fasta',
+        cancellable(checker.feed, cancelled), writer=writer, resume=resume,
+        committed=committed)
+    checker.finish()
+    return filename_remote
+
 
 def validate_metadata(metadata_file):
-    schema_resource = pkg_resources.resource_stream(__name__, "schema.yml")
-    cache = {
-        "https://raw.githubusercontent.com/bio-ontology-research-group/cborguploader/master/cborguploader/schema.yml": schema_resource.read().decode("utf-8")}
-    (document_loader,
-     avsc_names,
-     schema_metadata,
-     metaschema_loader) = schema_salad.schema.load_schema(
-         "https://raw.githubusercontent.com/bio-ontology-research-group/cborguploader/master/cborguploader/schema.yml",
-         cache=cache)
-
-    shex = pkg_resources.resource_stream(
-        __name__, "shex.rdf").read().decode("utf-8")
-
-    if not isinstance(avsc_names, schema_salad.avro.schema.Names):
-        print(avsc_names)
-        return False
+    return qc_metadata(metadata_file)
+
 
+def metadata_sample_id(metadata_file):
+    """Returns the sample id of a metadata file.
+
+    Raises ValueError if the file is not YAML or has no sample id, which
+    the full validation would reject as well.
+    """
     try:
-        doc, metadata = schema_salad.schema.load_and_validate(
-            document_loader, avsc_names, metadata_file, True)
-        g = schema_salad.jsonld_context.makerdf("workflow", doc, document_loader.ctx)
-        rslt, reason = evaluate(
-            g, shex, doc["id"],
-            "https://raw.githubusercontent.com/bio-ontology-research-group/cborguploader/master/cborguploader/shex.rdf#submissionShape")
-
-        if not rslt:
-            print(reason)
-
-        return rslt
-    except Exception as e:
-        traceback.print_exc()
-        logging.warn(e)
-    return False
+        with open(metadata_file) as f:
+            metadata = yaml.load(f, Loader=yaml.FullLoader)
+    except yaml.YAMLError as e:
+        raise ValueError('Metadata validation failed for %s: %s' % (
+            metadata_file, e))
+    sample = metadata.get('sample') if isinstance(metadata, dict) else None
+    sample_id = sample.get('sample_id') if isinstance(sample, dict) else None
+    if sample_id is None or isinstance(sample_id, (dict, list)):
+        raise ValueError('Metadata validation failed for %s: no sample id' % (
+            metadata_file))
+    return sample_id
 
-@ck.command()
-@ck.option(
-    '--uploader-project', '-up', required=True,
-    help='COVID19 FASTA/FASTQ sequences project uuid')
-@ck.option('--sequence-fasta', '-sf', help='FASTA File (*.fasta). FASTQ files are ignored if FASTA file is provided')
-@ck.option('--sequence-read1', '-sr1', help='FASTQ File (*.fastq) read 1')
-@ck.option('--sequence-read2', '-sr2', help='FASTQ File (*.fastq) read 2')
-@ck.option('--metadata-file', '-m', required=True, help='METADATA File')
-@ck.option('--no-sync', '-ns', is_flag=True)
-def main(uploader_project, sequence_fasta, sequence_read1, sequence_read2,
-         metadata_file, no_sync):
+
+def validate_sample(metadata_file, sequence_fasta=None, sequence_read1=None,
+                    sequence_read2=None):
+    """Runs the upload checks of a sample without contacting Arvados.
+
+    Raises ValueError if the sample fails validation.
+    """
+    if sequence_fasta is None and sequence_read1 is None:
+        raise ValueError('Please provide at least a FASTA file or FASTQ reads')
     if not validate_metadata(metadata_file):
-        return
-    metadata = yaml.load(open(metadata_file), Loader=yaml.FullLoader)
-    api = arvados.api('v1', host=ARVADOS_API_HOST, token=ARVADOS_API_TOKEN)
-    col = arvados.collection.Collection(api_client=api, num_retries=5)
-    is_fasta = False
-    is_paired = False
+        raise ValueError('Metadata validation failed for ' + metadata_file)
     if sequence_fasta is not None:
         validate_fasta(sequence_fasta)
-        upload_file(col, sequence_fasta, 'sequence.fasta')
-        is_fasta = True
-    elif sequence_read1 is not None:
-        validate_fastq(sequence_read1)
-        upload_file(col, sequence_read1, 'reads1.fastq')
-        if sequence_read2 is not None:
-            validate_fastq(sequence_read2)
-            upload_file(col, sequence_read2, 'reads2.fastq')
-            is_paired = True
+        return
+    validate_fastq(sequence_read1)
+    if sequence_read2 is not None:
+        validate_fastq(sequence_read2)
+
+
+def api_client(thread_safe=False):
+    # The Arvados client is imported on first use to keep startup fast
+    import arvados
+    if thread_safe:
+        from arvados.safeapi import ThreadSafeApiCache
+        # One client and Keep connection pool shared by all upload workers
+        return ThreadSafeApiCache(apiconfig={
+            'ARVADOS_API_HOST': ARVADOS_API_HOST,
+            'ARVADOS_API_TOKEN': ARVADOS_API_TOKEN})
+    return arvados.api('v1', host=ARVADOS_API_HOST, token=ARVADOS_API_TOKEN)
+
+
+def sync_upload(col_uuid, is_fasta, is_paired):
+    """Queues the synchronization of the upload on the web.
+
+    The event is sent by the background sync worker of the command, or by
+    a later run, so the upload does not wait for the portal.
+    """
+    data = {
+        'token': ARVADOS_API_TOKEN,
+        'col_uuid': col_uuid,
+        'is_fasta': is_fasta,
+        'is_paired': is_paired,
+        'status': 'uploaded'
+    }
+    enqueue(UPLOADER_URL + '/api/uploader/sync', col_uuid, data)
+
+
+def upload_sample(api, uploader_project, metadata_file, sequence_fasta=None,
+                  sequence_read1=None, sequence_read2=None, no_sync=False,
+                  force=False, put_threads=DEFAULT_PUT_THREADS,
+                  block_size=KEEP_BLOCK_SIZE):
+    """Validates and uploads one sample into a new collection.
+
+    Samples whose content already exists in the project are skipped before
+    anything is uploaded unless force is set, and interrupted uploads
+    continue after the last block that was written. The sample files are
+    validated while they are uploaded, concurrently with each other, in
+    blocks of block_size bytes by put_threads workers per file. Returns the API response of the
+    collection.
+    Raises ValueError if the sample fails validation.
+    """
+    if sequence_fasta is None and sequence_read1 is None:
+        raise ValueError('Please provide at least a FASTA file or FASTQ reads')
+    # Files that are not YAML or lack a sample id are rejected before the
+    # upload starts, the rest of the validation runs alongside it
+    sample_id = metadata_sample_id(metadata_file)
+    is_fasta = sequence_fasta is not None
+    is_paired = not is_fasta and sequence_read2 is not None
+    if is_fasta:
+        files = [('sequence', sequence_fasta)]
     else:
-        raise ck.UsageError('Please provide at least a FASTA file or FASTQ reads')
+        files = [('reads1', sequence_read1)]
+        if is_paired:
+            files.append(('reads2', sequence_read2))
+    files.append(('metadata', metadata_file))
 
-    upload_file(col, metadata_file, 'metadata.yaml')
-    
+    checkpoint = UploadCheckpoint(sample_key(files, block_size))
+    # A checkpoint of an earlier upload of the same files keeps their
+    # digest, otherwise it is computed from the local files so that a
+    # sample already in the project is found before anything is uploaded
+    digest = checkpoint.digest
+    if digest is None:
+        with span('content_digest'):
+            digest = content_digest(files)
+    if not force:
+        with span('api.find_existing'):
+            existing = find_existing(api, uploader_project, digest)
+        if existing is not None:
+            if checkpoint.digest is None:
+                checkpoint.complete(digest)
+            print('Sample %s is already uploaded as %s' % (
+                sample_id, existing['uuid']))
+            return existing
+    if checkpoint.digest is not None:
+        checkpoint.reset()
+
+    import arvados.collection
+    writer = BlockWriter(keep_client(api), put_threads, block_size)
+    col = arvados.collection.Collection(
+        checkpoint.manifest_text, api_client=api, keep_client=writer.keep,
+        num_retries=5)
     properties = {
-        "sequence_label": metadata['sample']['sample_id'],
+        "sequence_label": sample_id,
         "upload_app": "cborguploader",
         "is_fasta": is_fasta,
         "is_paired": is_paired
     }
+    # Every file is read once by its own thread, which feeds each chunk to
+    # the validator and the Keep writer, while the metadata is validated
+    # alongside. If anything fails the other uploads stop and the
+    # collection is not saved; blocks already written are left to Keep
+    # garbage collection.
+    cancelled = threading.Event()
+    checkpoint_lock = threading.Lock()
+
+    def upload_role(role, filename):
+        written = {}
+
+        def committed(locators, size):
+            written['locators'] = locators
+            with checkpoint_lock:
+                checkpoint.record_blocks(role, locators, size)
+
+        resume = checkpoint.resume_locators(role)
+        if resume:
+            print('Resuming upload of %s after %d bytes' % (
+                filename, checkpoint.partial[role]['size']))
+        try:
+            if role == 'sequence':
+                filename_remote = upload_fasta(
+                    col, filename, writer, cancelled, resume, committed)
+                stats = None
+            elif role == 'metadata':
+                filename_remote = upload_file(
+                    col, filename, 'metadata.yaml',
+                    cancellable(None, cancelled), writer=writer,
+                    resume=resume, committed=committed)
+                stats = None
+            else:
+                filename_remote, stats = upload_fastq(
+                    col, filename, role + '.fastq', writer, cancelled,
+                    resume, committed)
+        except BaseException:
+            cancelled.set()
+            raise
+        with checkpoint_lock:
+            checkpoint.record(
+                role, filename_remote, col.manifest_text(),
+                written['locators'], stats)
+        return filename_remote, stats
+
+    def check_metadata():
+        try:
+            valid = validate_metadata(metadata_file)
+        except BaseException:
+            cancelled.set()
+            raise
+        if not valid:
+            cancelled.set()
+        return valid
+
+    pending = []
+    for role, filename in files:
+        if role in checkpoint.files:
+            print('Resuming upload, %s is already uploaded' % filename)
+        else:
+            pending.append((role, filename))
+    with ThreadPoolExecutor(max_workers=len(pending) + 1) as executor:
+        metadata_valid = executor.submit(check_metadata)
+        uploads = [(role, executor.submit(upload_role, role, filename))
+                   for role, filename in pending]
+    if not metadata_valid.result():
+        raise ValueError('Metadata validation failed for ' + metadata_file)
+    # Report the failure that caused the other uploads to be cancelled
+    errors = [future.exception() for role, future in uploads
+              if future.exception() is not None]
+    errors.sort(key=lambda e: isinstance(e, UploadCancelled))
+    if errors:
+        raise errors[0]
+    for role, filename in files:
+        stats = checkpoint.files[role]['stats']
+        if stats is not None:
+            properties[role + '_file'] = checkpoint.files[role]['name']
+            properties[role + '_stats'] = stats
+    properties['content_digest'] = digest
 
-    col.save_new(
-        owner_uuid=uploader_project, name=metadata['sample']['sample_id'],
-        properties=properties, ensure_unique_name=True)
+    with span('save_new'):
+        col.save_new(
+            owner_uuid=uploader_project,
+            name=sample_id, properties=properties,
+            ensure_unique_name=True)
+    checkpoint.complete(digest)
     response = col.api_response()
-    print(json.dumps(response))
     if not no_sync:
-        col_uuid = response['uuid']
-        data = {
-            'token': ARVADOS_API_TOKEN,
-            'col_uuid': col_uuid,
-            'is_fasta': is_fasta,
-            'is_paired': is_paired,
-            'status': 'uploaded'
-        }
-        # Synchronize the upload on the web
-        r = requests.post(UPLOADER_URL + '/api/uploader/sync', data=data)
-    
+        sync_upload(response['uuid'], is_fasta, is_paired)
+    return response
+
+
+@ck.command()
+@ck.option(
+    '--uploader-project', '-up',
+    help='COVID19 FASTA/FASTQ sequences project uuid, required unless '
+    '--validate-only is given')
+@ck.option('--sequence-fasta', '-sf', help='FASTA File (*.fasta, *.fasta.gz). FASTQ files are ignored if FASTA file is provided')
+@ck.option('--sequence-read1', '-sr1', help='FASTQ File (*.fastq, *.fastq.gz, *.fastq.zst) read 1')
+@ck.option('--sequence-read2', '-sr2', help='FASTQ File (*.fastq, *.fastq.gz, *.fastq.zst) read 2')
+@ck.option('--metadata-file', '-m', required=True, help='METADATA File')
+@ck.option('--no-sync', '-ns', is_flag=True)
+@ck.option('--force', '-f', is_flag=True, help='Upload even if the same files were already uploaded to the project')
+@ck.option('--put-threads', '-pt', default=DEFAULT_PUT_THREADS, help='Number of concurrent Keep block uploads')
+@ck.option('--block-size', '-bs', default=64, type=ck.IntRange(1, 64), help='Keep block size in MiB')
+@ck.option('--metrics-out', default=None, help='Write stage timings and counters to this file, as a Prometheus textfile if it ends with .prom and JSON otherwise')
+@ck.option('--profile', default=None, help='Write cProfile statistics of the main thread to this file')
+@ck.option('--validate-only', '-vo', is_flag=True, help='Only validate the metadata and sequence files, nothing is uploaded')
+def main(uploader_project, sequence_fasta, sequence_read1, sequence_read2,
+         metadata_file, no_sync, force, put_threads, block_size, metrics_out,
+         profile, validate_only):
+    if sequence_fasta is None and sequence_read1 is None:
+        raise ck.UsageError('Please provide at least a FASTA file or FASTQ reads')
+    if uploader_project is None and not validate_only:
+        raise ck.UsageError('Missing option --uploader-project / -up')
+    try:
+        with reporting(metrics_out, profile):
+            if validate_only:
+                validate_sample(metadata_file, sequence_fasta,
+                                sequence_read1, sequence_read2)
+                print('Sample is valid')
+                return
+            api = api_client()
+            with background_sync(not no_sync):
+                response = upload_sample(
+                    api, uploader_project, metadata_file, sequence_fasta,
+                    sequence_read1, sequence_read2, no_sync, force,
+                    put_threads, block_size << 20)
+    except ValueError as e:
+        print(e)
+        if validate_only:
+            sys.exit(1)
+        return
+    print(json.dumps(response))
 
     # res_uri = ARVADOS_COL_BASE_URI + response['uuid']
     # graph = to_rdf(res_uri, args.metadata.name)
@@ -0,0 +1,3 @@
+# Columns of the sample manifests read by cborguploader-batch and written
+# by metacon.py. Kept free of imports so metacon.py loads quickly.
+MANIFEST_COLUMNS = ['sample', 'metadata', 'fasta', 'read1', 'read2']
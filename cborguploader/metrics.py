@@ -0,0 +1,150 @@
+import contextlib
+import cProfile
+import functools
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+# Prefix of the exported Prometheus metric names
+PROMETHEUS_PREFIX = 'cborguploader'
+
+_NULL_SPAN = contextlib.nullcontext()
+
+
+class Metrics(object):
+    """Timers for named stages (spans) and counters, e.g. of bytes.
+
+    Nothing is recorded until enable() is called, so instrumented code
+    only pays for a flag check when metrics are off.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self.spans = {}
+        self.counters = {}
+
+    def enable(self):
+        self.enabled = True
+
+    def reset(self):
+        with self._lock:
+            self.spans = {}
+            self.counters = {}
+
+    def span(self, name):
+        """Returns a context manager that times the block as name."""
+        if not self.enabled:
+            return _NULL_SPAN
+        return self._span(name)
+
+    @contextlib.contextmanager
+    def _span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def observe(self, name, seconds):
+        with self._lock:
+            count, total, maximum = self.spans.get(name, (0, 0.0, 0.0))
+            self.spans[name] = (count + 1, total + seconds,
+                                max(maximum, seconds))
+
+    def count(self, name, value=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def to_json(self):
+        with self._lock:
+            return {
+                'spans': {name: {'count': count, 'seconds': total,
+                                 'max_seconds': maximum}
+                          for name, (count, total, maximum)
+                          in sorted(self.spans.items())},
+                'counters': dict(sorted(self.counters.items())),
+            }
+
+    def to_prometheus(self, prefix=PROMETHEUS_PREFIX):
+        """Returns the metrics in the Prometheus text exposition format."""
+        report = self.to_json()
+        lines = []
+        for suffix, key, kind in [('span_seconds_total', 'seconds', 'counter'),
+                                  ('span_count', 'count', 'counter'),
+                                  ('span_max_seconds', 'max_seconds', 'gauge')]:
+            lines.append('# TYPE %s_%s %s' % (prefix, suffix, kind))
+            for name, span in report['spans'].items():
+                lines.append('%s_%s{span="%s"} %s' % (
+                    prefix, suffix, name, span[key]))
+        for name, value in report['counters'].items():
+            metric = '%s_%s_total' % (prefix, re.sub(r'[^a-zA-Z0-9_]', '_', name))
+            lines.append('# TYPE %s counter' % metric)
+            lines.append('%s %s' % (metric, value))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """Writes a Prometheus textfile if path ends with .prom, JSON
+        otherwise. The file is replaced atomically so that collectors
+        never read a partial report."""
+        if path.endswith('.prom'):
+            text = self.to_prometheus()
+        else:
+            text = json.dumps(self.to_json(), indent=2) + '\n'
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+
+
+metrics = Metrics()
+
+
+def span(name):
+    return metrics.span(name)
+
+
+def count(name, value=1):
+    metrics.count(name, value)
+
+
+def timed(name):
+    """Decorator that times every call of a function as a span."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not metrics.enabled:
+                return fn(*args, **kwargs)
+            with metrics.span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextlib.contextmanager
+def reporting(metrics_out=None, profile_out=None):
+    """Enables metrics and profiling for a command run.
+
+    The metrics are written to metrics_out and cProfile statistics to
+    profile_out when the block exits, also if it fails.
+    """
+    if metrics_out is not None:
+        metrics.enable()
+    profiler = None
+    if profile_out is not None:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        yield metrics
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile_out)
+            logging.info('Wrote profile to %s', profile_out)
+        if metrics_out is not None:
+            metrics.write(metrics_out)
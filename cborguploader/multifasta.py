@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+import click as ck
+import os
+import sys
+import logging
+import tempfile
+import yaml
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from cborguploader.batch import print_results
+from cborguploader.blockwriter import DEFAULT_PUT_THREADS
+from cborguploader.compression import open_text
+from cborguploader.main import api_client, upload_sample
+from cborguploader.metrics import reporting, span
+from cborguploader.qc_fasta import (
+    check_sequence, clean_sequence, iter_fasta, read_fasta)
+from cborguploader.sync import background_sync
+
+METADATA_SUFFIXES = ('.yaml', '.yml')
+
+
+def read_metadata_index(paths):
+    """Maps sample ids and file name stems to metadata files.
+
+    paths are metadata files or directories containing them.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(
+                os.path.join(path, name) for name in sorted(os.listdir(path))
+                if name.endswith(METADATA_SUFFIXES))
+        else:
+            files.append(path)
+    index = {}
+    for filename in files:
+        with open(filename) as f:
+            metadata = yaml.load(f, Loader=yaml.FullLoader)
+        try:
+            sample_id = str(metadata['sample']['sample_id'])
+        except (KeyError, TypeError):
+            logging.warning('%s has no sample_id', filename)
+        else:
+            index[sample_id] = filename
+        index.setdefault(
+            os.path.splitext(os.path.basename(filename))[0], filename)
+    return index
+
+
+def record_id(label):
+    """Returns the first word of a FASTA header."""
+    words = label[1:].split()
+    return words[0] if words else ''
+
+
+def match_metadata(name, index):
+    """Returns the metadata file of a FASTA record or None.
+
+    The record id is looked up first, then each of its |-separated
+    fields, so GISAID style headers match their accession.
+    """
+    for key in [name] + name.split('|'):
+        if key in index:
+            return index[key]
+    return None
+
+
+def split_records(fasta_file, out_dir):
+    """Writes every record of a multi-FASTA file to its own file.
+
+    Yields (record id, filename) pairs while the input is streamed.
+    """
+    with open_text(fasta_file) as f:
+        for i, (label, bases) in enumerate(iter_fasta(f)):
+            filename = os.path.join(out_dir, 'record%d.fasta' % (i + 1))
+            with open(filename, 'w') as out:
+                out.write(label)
+                out.writelines(bases)
+            yield record_id(label) or 'record%d' % (i + 1), filename
+
+
+def qc_record(filename):
+    """Runs reference QC on a single record file.
+
+    Returns None if the record passes, otherwise the reason it failed.
+    """
+    try:
+        with open(filename) as f:
+            label, bases = read_fasta(f)
+        check_sequence(clean_sequence(bases))
+    except ValueError as e:
+        return str(e)
+    return None
+
+
+def upload_record(api, uploader_project, name, metadata_file, filename,
+                  no_sync, force, put_threads):
+    try:
+        response = upload_sample(
+            api, uploader_project, metadata_file, sequence_fasta=filename,
+            no_sync=no_sync, force=force, put_threads=put_threads)
+        return name, 'uploaded', response['uuid']
+    except Exception as e:
+        logging.exception('Upload of %s failed', name)
+        return name, 'failed', str(e)
+
+
+def upload_multifasta(api, uploader_project, fasta_file, metadata_index,
+                      qc_jobs=None, jobs=4, no_sync=False, force=False,
+                      put_threads=DEFAULT_PUT_THREADS):
+    """Uploads every record of a multi-FASTA file as its own sample.
+
+    Records are streamed into a process pool for reference QC and the
+    passing ones are uploaded by a pool of jobs threads while the rest of
+    the file is still being checked. Returns one (record, status, result)
+    tuple per record in input order.
+    """
+    results = []
+    seen = set()
+    with tempfile.TemporaryDirectory() as tmp_dir, \
+            ProcessPoolExecutor(max_workers=qc_jobs) as qc_executor, \
+            ThreadPoolExecutor(max_workers=jobs) as upload_executor:
+        checks = []
+        for name, filename in split_records(fasta_file, tmp_dir):
+            metadata_file = match_metadata(name, metadata_index)
+            if name in seen:
+                results.append((name, 'failed', 'Duplicate record'))
+            elif metadata_file is None:
+                results.append((name, 'failed', 'No metadata for record'))
+            else:
+                checks.append((len(results), name, metadata_file,
+                               qc_executor.submit(qc_record, filename),
+                               filename))
+                results.append(None)
+            seen.add(name)
+        uploads = []
+        for i, name, metadata_file, check, filename in checks:
+            # QC runs in other processes, only the wait is measured here
+            with span('qc_wait'):
+                error = check.result()
+            if error is not None:
+                results[i] = (name, 'failed', error)
+            else:
+                uploads.append((i, upload_executor.submit(
+                    upload_record, api, uploader_project, name,
+                    metadata_file, filename, no_sync, force, put_threads)))
+        for i, upload in uploads:
+            results[i] = upload.result()
+    return results
+
+
+@ck.command()
+@ck.option(
+    '--uploader-project', '-up', required=True,
+    help='COVID19 FASTA/FASTQ sequences project uuid')
+@ck.option('--sequence-fasta', '-sf', required=True, help='Multi-FASTA File (*.fasta, *.fasta.gz)')
+@ck.option(
+    '--metadata', '-m', required=True, multiple=True,
+    help='METADATA File or directory of METADATA Files, matched to records '
+    'by sample_id or file name')
+@ck.option('--jobs', '-j', default=4, help='Number of concurrent uploads')
+@ck.option('--qc-jobs', '-qj', default=None, type=int, help='Number of QC processes, defaults to the number of CPUs')
+@ck.option('--no-sync', '-ns', is_flag=True)
+@ck.option('--force', '-f', is_flag=True, help='Upload records even if the same files were already uploaded to the project')
+@ck.option('--put-threads', '-pt', default=DEFAULT_PUT_THREADS, help='Number of concurrent Keep block uploads per record')
+@ck.option('--metrics-out', default=None, help='Write stage timings and counters to this file, as a Prometheus textfile if it ends with .prom and JSON otherwise')
+@ck.option('--profile', default=None, help='Write cProfile statistics of the main thread to this file')
+def main(uploader_project, sequence_fasta, metadata, jobs, qc_jobs, no_sync,
+         force, put_threads, metrics_out, profile):
+    metadata_index = read_metadata_index(metadata)
+    if not metadata_index:
+        raise ck.UsageError('No metadata files found')
+    api = api_client(thread_safe=True)
+    with reporting(metrics_out, profile), background_sync(not no_sync):
+        results = upload_multifasta(
+            api, uploader_project, sequence_fasta, metadata_index, qc_jobs,
+            jobs, no_sync, force, put_threads)
+    if not results:
+        raise ck.UsageError('No records found in ' + sequence_fasta)
+    print_results(results)
+    failed = sum(1 for r in results if r[1] != 'uploaded')
+    print(f'Uploaded {len(results) - failed} of {len(results)} records')
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,70 @@
-import pkg_resources
-import tempfile
-import magic
-import subprocess
-import tempfile
+import bisect
+import functools
 import logging
 import re
 
+from cborguploader.formats import SNIFF_SIZE, detect_format
+from cborguploader.metrics import span
+
+# k-mer size used to estimate identity to the reference
+KMER_SIZE = 16
+# Estimates closer than this to the threshold are checked with an alignment.
+# Below the threshold the margin is wider because the estimate drops faster
+# than identity once few k-mers survive.
+AMBIGUOUS_MARGIN = 5.0
+AMBIGUOUS_MARGIN_BELOW = 15.0
+# Larger unanchored segments are not aligned but counted as differences
+MAX_GAP_CELLS = 25000000
+
+MIN_LENGTH_RATIO = .7
+MAX_LENGTH_RATIO = 1.3
+MIN_SIMILARITY = 70.0
+
+# Residue codes and gaps accepted in FASTA sequence lines
+SEQUENCE_ALPHABET = (b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+                     b"*-. \t\r")
+
+class FastaChecker(object):
+    """Streaming FASTA validator, fed in chunks like FastqChecker.
+
+    finish() must be called after the last chunk and returns the number of
+    records and bases. Invalid input raises ValueError.
+    """
+
+    def __init__(self):
+        self.record_count = 0
+        self.total_bases = 0
+        self._partial = b""
+
+    def feed(self, chunk):
+        lines = (self._partial + chunk).split(b"\n")
+        self._partial = lines.pop()
+        self._check_lines(lines)
+
+    def finish(self):
+        if self._partial:
+            self._check_lines([self._partial])
+            self._partial = b""
+        if self.record_count == 0:
+            raise ValueError("FASTA file contains no sequences")
+        return {"record_count": self.record_count,
+                "total_bases": self.total_bases}
+
+    def _check_lines(self, lines):
+        seqs = []
+        for line in lines:
+            if line.startswith(b">"):
+                self.record_count += 1
+            elif self.record_count == 0:
+                if line.strip():
+                    raise ValueError("FASTA file does not start with a header")
+            else:
+                seqs.append(line)
+        seq = b"".join(seqs)
+        if seq.translate(None, SEQUENCE_ALPHABET):
+            raise ValueError("FASTA file has invalid sequence characters")
+        self.total_bases += len(seq.translate(None, b" \t\r"))
+
 def read_fasta(sequence):
     entries = 0
     bases = []
@@ -21,52 +80,182 @@ def read_fasta(sequence):
             break
     return label, bases
 
+def iter_fasta(sequence):
+    """Yields the (label, bases) of every entry in a FASTA file."""
+    label = None
+    bases = []
+    for line in sequence:
+        if line.startswith(">"):
+            if label is not None:
+                yield label, bases
+            label = line
+            bases = []
+        elif label is not None:
+            bases.append(line)
+    if label is not None:
+        yield label, bases
+
+def clean_sequence(bases):
+    return "".join("".join(bases).split()).upper()
+
+def kmer_positions(seq, k=KMER_SIZE):
+    """Yields the position and k-mer of every k-mer of seq with only ACGT."""
+    for run in re.finditer("[ACGT]{%d,}" % k, seq):
+        start, run = run.start(), run.group()
+        for i in range(len(run) - k + 1):
+            yield start + i, run[i:i + k]
+
+@functools.lru_cache(maxsize=None)
+def reference():
+    """Returns the reference sequence and the positions of its k-mers that
+    occur once, loaded on first use."""
+    import pkg_resources
+    lines = pkg_resources.resource_string(
+        __name__, "SARS-CoV-2-reference.fasta").decode("utf-8").splitlines()
+    seq = clean_sequence(line for line in lines if not line.startswith(">"))
+    index = {}
+    for i, kmer in kmer_positions(seq):
+        index[kmer] = None if kmer in index else i
+    return seq, {kmer: i for kmer, i in index.items() if i is not None}
+
+def anchor_chain(seq):
+    """Returns the longest chain of (position, reference position) k-mer
+    matches that is colinear with the reference.
+
+    Only k-mers that occur once in the reference are used, so repeated or
+    duplicated sequence cannot match more than once.
+    """
+    index = reference()[1]
+    hits = [(i, index[kmer]) for i, kmer in kmer_positions(seq)
+            if kmer in index]
+    # Longest strictly increasing subsequence of the reference positions
+    tails = []
+    tail_hits = []
+    previous = [None] * len(hits)
+    for h, (i, j) in enumerate(hits):
+        n = bisect.bisect_left(tails, j)
+        if n == len(tails):
+            tails.append(j)
+            tail_hits.append(h)
+        else:
+            tails[n] = j
+            tail_hits[n] = h
+        previous[h] = tail_hits[n - 1] if n else None
+    chain = []
+    h = tail_hits[-1] if tail_hits else None
+    while h is not None:
+        chain.append(hits[h])
+        h = previous[h]
+    chain.reverse()
+    return chain
+
+def kmer_identity(seq, chain=None):
+    """Estimates % identity to the reference from k-mer matches.
+
+    A k-mer survives with probability identity**k, so the fraction of k-mer
+    positions matched by the colinear chain gives identity back. The
+    fraction is taken of the longer of the two sequences and the estimate
+    is scaled by the part of both sequences spanned by the chain, so
+    repeats, truncations and unrelated sequence lower the score.
+    """
+    ref = reference()[0]
+    if chain is None:
+        chain = anchor_chain(seq)
+    if not chain:
+        return 0.0
+    k = KMER_SIZE
+    containment = len(chain) / (max(len(seq), len(ref)) - k + 1)
+    span = min((chain[-1][0] - chain[0][0] + k) / len(seq),
+               (chain[-1][1] - chain[0][1] + k) / len(ref))
+    return 100.0 * containment ** (1.0 / k) * span
+
+@functools.lru_cache(maxsize=None)
+def edit_aligner():
+    """Returns a global aligner whose score is minus the edit distance."""
+    from Bio.Align import PairwiseAligner
+    aligner = PairwiseAligner()
+    aligner.mode = "global"
+    aligner.match_score = 0
+    aligner.mismatch_score = -1
+    aligner.open_gap_score = -1
+    aligner.extend_gap_score = -1
+    return aligner
+
+def gap_distance(a, b):
+    """Returns the edit distance of two unanchored segments, or an upper
+    bound on it if aligning them would take more than MAX_GAP_CELLS."""
+    if not a or not b or len(a) * len(b) > MAX_GAP_CELLS:
+        return max(len(a), len(b))
+    return -int(edit_aligner().score(a, b))
+
+def anchored_identity(seq, chain=None):
+    """Computes % identity from a global alignment anchored on the k-mer
+    chain. Only the segments between anchors are aligned, so the cost
+    depends on the divergent regions rather than on the genome length."""
+    ref = reference()[0]
+    if chain is None:
+        chain = anchor_chain(seq)
+    if not seq:
+        return 0.0
+    k = KMER_SIZE
+    distance = 0
+    # End of the current exact match block and its diagonal
+    qend = rend = 0
+    diagonal = None
+    for i, j in chain:
+        if i - j == diagonal and i <= qend:
+            qend, rend = i + k, j + k
+        elif i >= qend and j >= rend:
+            distance += gap_distance(seq[qend:i], ref[rend:j])
+            qend, rend, diagonal = i + k, j + k, i - j
+    distance += gap_distance(seq[qend:], ref[rend:])
+    return max(0.0, 100.0 * (1.0 - distance / min(len(seq), len(ref))))
+
+def similarity(seq, threshold=MIN_SIMILARITY):
+    """Returns the % identity of seq to the reference.
+
+    The k-mer estimate is used when it is clearly above or below the
+    threshold, otherwise the anchored alignment decides.
+    """
+    chain = anchor_chain(seq)
+    estimate = kmer_identity(seq, chain)
+    if not (threshold - AMBIGUOUS_MARGIN_BELOW <= estimate
+            <= threshold + AMBIGUOUS_MARGIN):
+        return estimate
+    return anchored_identity(seq, chain)
+
+def check_sequence(submit):
+    """Checks a cleaned sequence against the reference.
+
+    Returns the similarity to the reference, raises ValueError if the
+    sequence fails QC.
+    """
+    refbp = float(len(reference()[0]))
+    subbp = float(len(submit))
+    if (subbp/refbp) < MIN_LENGTH_RATIO:
+        raise ValueError("QC fail: submit sequence length is shorter than 70% reference")
+    if (subbp/refbp) > MAX_LENGTH_RATIO:
+        raise ValueError("QC fail: submit sequence length is greater than 130% reference")
+    with span("qc_similarity"):
+        score = similarity(submit)
+    if score < MIN_SIMILARITY:
+        raise ValueError("QC fail: submit similarity is less than 70%")
+    return score
+
 def qc_fasta(sequence):
-    schema_resource = pkg_resources.resource_stream(__name__, "validation/formats")
-    with tempfile.NamedTemporaryFile() as tmp:
-        tmp.write(schema_resource.read())
-        tmp.flush()
-        val = magic.Magic(magic_file=tmp.name,
-                          uncompress=False, mime=True)
-    seq_type = val.from_buffer(sequence.read(4096)).lower()
+    seq_type = detect_format(sequence.read(SNIFF_SIZE))
     sequence.seek(0)
     if seq_type == "text/fasta":
         # ensure that contains only one entry
         submitlabel, submitseq = read_fasta(sequence)
         sequence.seek(0)
 
-        with tempfile.NamedTemporaryFile() as tmp1:
-            refstring = pkg_resources.resource_string(__name__, "SARS-CoV-2-reference.fasta")
-            tmp1.write(refstring)
-            tmp1.write(submitlabel.encode("utf8"))
-            tmp1.write(("".join(submitseq)).encode("utf8"))
-            tmp1.flush()
-            try:
-                cmd = ["clustalw", "-infile="+tmp1.name,
-                       "-quicktree", "-iteration=none", "-type=DNA"]
-                print("QC checking similarity to reference")
-                print(" ".join(cmd))
-                result = subprocess.run(cmd, stdout=subprocess.PIPE)
-                res = result.stdout.decode("utf-8")
-                g1 = re.search(r"^Sequence 1: [^ ]+ +(\d+) bp$", res, flags=re.MULTILINE)
-                refbp = float(g1.group(1))
-                g2 = re.search(r"^Sequence 2: [^ ]+ +(\d+) bp$", res, flags=re.MULTILINE)
-                subbp = float(g2.group(1))
-                g3 = re.search(r"^Sequences \(1:2\) Aligned\. Score: (\d+(\.\d+)?)$", res, flags=re.MULTILINE)
-                similarity = float(g3.group(1))
-
-                print(g1.group(0))
-                print(g2.group(0))
-                print(g3.group(0))
-            except Exception as e:
-                logging.warn("Error trying to QC against reference sequence using 'clustalw': %s", e)
-
-            if (subbp/refbp) < .7:
-                raise ValueError("QC fail: submit sequence length is shorter than 70% reference")
-            if (subbp/refbp) > 1.3:
-                raise ValueError("QC fail: submit sequence length is greater than 130% reference")
-            if similarity < 70.0:
-                raise ValueError("QC fail: submit similarity is less than 70%")
+        submit = clean_sequence(submitseq)
+        print("QC checking similarity to reference")
+        print("Reference: %d bp" % len(reference()[0]))
+        print("Submission: %d bp" % len(submit))
+        score = check_sequence(submit)
+        print("Similarity: %.1f%%" % score)
 
         return "sequence.fasta"
     elif seq_type == "text/fastq":
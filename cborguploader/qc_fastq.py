@@ -1,19 +1,138 @@
-import pkg_resources
-import tempfile
-import magic
-import subprocess
-import tempfile
 import logging
-import re
+from collections import Counter
+
+from cborguploader.formats import SNIFF_SIZE, detect_format
+
+# Nucleotide IUPAC codes accepted in FASTQ sequence lines
+SEQUENCE_ALPHABET = b'ACGTUNRYKMSWBDHVacgtunrykmswbdhv.-'
+# Phred+33 quality characters
+QUALITY_ALPHABET = bytes(range(33, 127))
+
+
+def length_bin(bits):
+    """Returns the label of the read lengths with the given bit length."""
+    if bits == 0:
+        return '0'
+    return '%d-%d' % (1 << (bits - 1), (1 << bits) - 1)
+
+
+class FastqChecker(object):
+    """Streaming FASTQ validator that also collects read statistics.
+
+    Data is fed in arbitrary chunks with feed(), so the checker can run on
+    the same reads that are being uploaded. finish() must be called after
+    the last chunk. Invalid input raises ValueError.
+    """
+
+    def __init__(self):
+        self.read_count = 0
+        self.total_bases = 0
+        self.quality_sum = 0
+        self.min_length = None
+        self.max_length = 0
+        # Read counts per power of two bin of the read length, keyed by
+        # the bit length, so the histogram stays small for long reads
+        self.length_bins = Counter()
+        self._strip_cr = False
+        self._partial = b''
+        self._pending = []
+
+    def feed(self, chunk):
+        if not self._strip_cr and b'\r' in chunk:
+            self._strip_cr = True
+        lines = (self._partial + chunk).split(b'\n')
+        self._partial = lines.pop()
+        if self._pending:
+            lines = self._pending + lines
+        n = len(lines) - len(lines) % 4
+        self._pending = lines[n:]
+        if n:
+            self._check_records(lines[:n])
+
+    def finish(self):
+        lines = self._pending
+        if self._partial:
+            lines.append(self._partial)
+        while lines and not lines[-1].strip():
+            lines.pop()
+        self._pending = []
+        self._partial = b''
+        if len(lines) % 4:
+            raise ValueError(
+                'FASTQ record %d is truncated' % (self.read_count + 1))
+        if lines:
+            self._check_records(lines)
+        if self.read_count == 0:
+            raise ValueError('FASTQ file contains no reads')
+        return self.stats()
+
+    def _check_records(self, lines):
+        if self._strip_cr:
+            lines = [line.rstrip(b'\r') for line in lines]
+        headers = lines[0::4]
+        seqs = lines[1::4]
+        pluses = lines[2::4]
+        quals = lines[3::4]
+        seq_lengths = list(map(len, seqs))
+        qual_lengths = list(map(len, quals))
+        all_quals = b''.join(quals)
+        if (not all(h[:1] == b'@' for h in headers)
+                or not all(p[:1] == b'+' for p in pluses)
+                or seq_lengths != qual_lengths
+                or b''.join(seqs).translate(None, SEQUENCE_ALPHABET)
+                or all_quals.translate(None, QUALITY_ALPHABET)):
+            self._raise_error(headers, seqs, pluses, quals)
+        self.read_count += len(seqs)
+        self.total_bases += len(all_quals)
+        self.quality_sum += sum(all_quals) - 33 * len(all_quals)
+        self.length_bins.update(map(int.bit_length, seq_lengths))
+        shortest = min(seq_lengths)
+        if self.min_length is None or shortest < self.min_length:
+            self.min_length = shortest
+        self.max_length = max(self.max_length, max(seq_lengths))
+
+    def _raise_error(self, headers, seqs, pluses, quals):
+        for i, (h, s, p, q) in enumerate(zip(headers, seqs, pluses, quals)):
+            record = self.read_count + i + 1
+            if h[:1] != b'@':
+                raise ValueError(
+                    'FASTQ record %d header does not start with @' % record)
+            if p[:1] != b'+':
+                raise ValueError(
+                    'FASTQ record %d separator does not start with +' % record)
+            if len(s) != len(q):
+                raise ValueError(
+                    'FASTQ record %d sequence and quality lengths differ'
+                    % record)
+            if s.translate(None, SEQUENCE_ALPHABET):
+                raise ValueError(
+                    'FASTQ record %d has invalid sequence characters' % record)
+            if q.translate(None, QUALITY_ALPHABET):
+                raise ValueError(
+                    'FASTQ record %d has invalid quality characters' % record)
+
+    def stats(self):
+        mean_quality = 0.0
+        if self.total_bases:
+            mean_quality = round(self.quality_sum / self.total_bases, 2)
+        mean_length = 0.0
+        if self.read_count:
+            mean_length = round(self.total_bases / self.read_count, 2)
+        return {
+            'read_count': self.read_count,
+            'total_bases': self.total_bases,
+            'mean_quality': mean_quality,
+            'min_length': self.min_length or 0,
+            'max_length': self.max_length,
+            'mean_length': mean_length,
+            'length_histogram': {
+                length_bin(bits): n
+                for bits, n in sorted(self.length_bins.items())},
+        }
+
 
 def qc_fastq(sequence):
-    schema_resource = pkg_resources.resource_stream(__name__, "validation/formats")
-    with tempfile.NamedTemporaryFile() as tmp:
-        tmp.write(schema_resource.read())
-        tmp.flush()
-        val = magic.Magic(magic_file=tmp.name,
-                          uncompress=False, mime=True)
-    seq_type = val.from_buffer(sequence.read(4096)).lower()
+    seq_type = detect_format(sequence.read(SNIFF_SIZE))
     sequence.seek(0)
     if seq_type == "text/fastq":
         return "reads.fastq"
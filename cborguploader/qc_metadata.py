@@ -1,56 +1,165 @@
-import schema_salad.schema
-import schema_salad.ref_resolver
-import schema_salad.jsonld_context
-import logging
-import pkg_resources
+import hashlib
 import logging
+import os
+import pickle
+import threading
 import traceback
-from rdflib import Graph, Namespace
-from pyshex.evaluate import evaluate
 
-def qc_metadata(metadatafile):
-    schema_resource = pkg_resources.resource_stream(__name__, "bh20seq-schema.yml")
-    cache = {"https://raw.githubusercontent.com/bio-ontology-research-group/bh20-seq-resource/master/bh20sequploader/bh20seq-schema.yml": schema_resource.read().decode("utf-8")}
-    (document_loader,
-     avsc_names,
-     schema_metadata,
-     metaschema_loader) = schema_salad.schema.load_schema("https://raw.githubusercontent.com/bio-ontology-research-group/bh20-seq-resource/master/bh20sequploader/bh20seq-schema.yml", cache=cache)
+from cborguploader.metrics import span
+
+SCHEMA_URL = "https://raw.githubusercontent.com/bio-ontology-research-group/cborguploader/master/cborguploader/schema.yml"
+SHEX_URL = "https://raw.githubusercontent.com/bio-ontology-research-group/cborguploader/master/cborguploader/shex.rdf"
+SUBMISSION_SHAPE = SHEX_URL + "#submissionShape"
+
+
+class MetadataValidator(object):
+    """Loads the metadata schema and compiles the ShEx shape once so that
+    many documents can be validated with the same instance.
+
+    If cache_dir is given the compiled schemas are pickled there, keyed by
+    the hash of schema.yml and shex.rdf, to make cold starts fast.
+    """
+
+    def __init__(self, cache_dir=None):
+        # schema_salad and pyshex take long to import, so they are only
+        # loaded once a validator is needed
+        import pkg_resources
+        import schema_salad.schema
+        from pyshex.utils.schema_loader import SchemaLoader
+        self._lock = threading.Lock()
+        schema_text = pkg_resources.resource_string(__name__, "schema.yml")
+        shex_text = pkg_resources.resource_string(__name__, "shex.rdf")
+        self.schema_hash = hashlib.sha256(schema_text + shex_text).hexdigest()
+        self.from_cache = False
+        cache_file = None
+        if cache_dir is not None:
+            cache_file = os.path.join(
+                cache_dir, 'metadata-schema-%s.pickle' % self.schema_hash)
+        if cache_file is not None and os.path.exists(cache_file):
+            try:
+                with open(cache_file, 'rb') as f:
+                    (self.document_loader, self.avsc_names,
+                     shexj) = pickle.load(f)
+                # The compiled shape holds modules, so it is cached as
+                # ShExJ and parsed again, which is much faster than ShExC
+                self.shex = SchemaLoader().loads(shexj)
+                self._init_loader()
+                self.from_cache = True
+                return
+            except Exception as e:
+                logging.warning('Ignoring unreadable schema cache %s: %s',
+                                cache_file, e)
+        cache = {SCHEMA_URL: schema_text.decode("utf-8")}
+        with span('metadata_schema_load'):
+            (self.document_loader,
+             self.avsc_names,
+             schema_metadata,
+             metaschema_loader) = schema_salad.schema.load_schema(
+                 SCHEMA_URL, cache=cache)
+            if not isinstance(self.avsc_names,
+                              schema_salad.avro.schema.Names):
+                raise ValueError(str(self.avsc_names))
+            self.shex = SchemaLoader().loads(shex_text.decode("utf-8"))
+        self._init_loader()
+        if cache_file is not None:
+            self._save_cache(cache_file)
+
+    def _init_loader(self):
+        # Documents fetched and parsed by the loader are indexed by URL.
+        # Only the schema entries are kept between documents, so a file
+        # that changed is read again and the index does not grow.
+        self._indexes = [self.document_loader.idx]
+        fetcher_cache = getattr(self.document_loader.fetcher, 'cache', None)
+        if fetcher_cache is not None:
+            self._indexes.append(fetcher_cache)
+        self._schema_keys = [set(index) for index in self._indexes]
 
-    shex = pkg_resources.resource_stream(__name__, "bh20seq-shex.rdf").read().decode("utf-8")
+    def _forget_documents(self):
+        for index, schema_keys in zip(self._indexes, self._schema_keys):
+            for key in [key for key in index if key not in schema_keys]:
+                del index[key]
 
-    if not isinstance(avsc_names, schema_salad.avro.schema.Names):
-        print(avsc_names)
+    def _save_cache(self, cache_file):
+        from jsonasobj import as_json
+        tmp_file = cache_file + '.%d.tmp' % os.getpid()
+        try:
+            data = pickle.dumps(
+                (self.document_loader, self.avsc_names, as_json(self.shex)),
+                protocol=pickle.HIGHEST_PROTOCOL)
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            with open(tmp_file, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_file, cache_file)
+        except Exception as e:
+            logging.warning('Could not write schema cache %s: %s',
+                            cache_file, e)
+            try:
+                os.unlink(tmp_file)
+            except OSError:
+                pass
+
+    def load(self, metadata_file):
+        import schema_salad.schema
+        # The document loader is shared, so loading is serialized while
+        # ShEx evaluation runs in parallel
+        with self._lock, span('metadata_load'):
+            self._forget_documents()
+            try:
+                doc, metadata = schema_salad.schema.load_and_validate(
+                    self.document_loader, self.avsc_names, metadata_file,
+                    True)
+            finally:
+                self._forget_documents()
+        return doc
+
+    def validate(self, metadata_file):
+        import schema_salad.jsonld_context
+        from pyshex.evaluate import evaluate
+        try:
+            doc = self.load(metadata_file)
+            with span('shex_evaluate'):
+                g = schema_salad.jsonld_context.makerdf(
+                    "workflow", doc, self.document_loader.ctx)
+                rslt, reason = evaluate(
+                    g, self.shex, doc["id"], SUBMISSION_SHAPE)
+            if not rslt:
+                print(reason)
+            return rslt
+        except Exception as e:
+            traceback.print_exc()
+            logging.warning(e)
         return False
 
-    try:
-        doc, metadata = schema_salad.schema.load_and_validate(document_loader, avsc_names, metadatafile, True)
-        g = schema_salad.jsonld_context.makerdf("workflow", doc, document_loader.ctx)
-        rslt, reason = evaluate(g, shex, doc["id"], "https://raw.githubusercontent.com/bio-ontology-research-group/bh20-seq-resource/master/bh20sequploader/bh20seq-shex.rdf#submissionShape")
+    def to_rdf(self, uri, metadata_file):
+        import schema_salad.jsonld_context
+        doc = self.load(metadata_file)
+        doc["id"] = uri
+        return schema_salad.jsonld_context.makerdf(
+            "workflow", doc, self.document_loader.ctx)
 
-        if not rslt:
-            print(reason)
 
-        return rslt
-    except Exception as e:
-        traceback.print_exc()
-        logging.warn(e)
-    return False
+_validator = None
+_validator_lock = threading.Lock()
 
 
-def to_rdf(uri, metadatafile):
-    schema_resource = pkg_resources.resource_stream(__name__, "bh20seq-schema.yml")
-    cache = {"https://raw.githubusercontent.com/bio-ontology-research-group/bh20-seq-resource/master/bh20sequploader/bh20seq-schema.yml": schema_resource.read().decode("utf-8")}
-    (document_loader,
-     avsc_names,
-     schema_metadata,
-     metaschema_loader) = schema_salad.schema.load_schema("https://raw.githubusercontent.com/bio-ontology-research-group/bh20-seq-resource/master/bh20sequploader/bh20seq-schema.yml", cache=cache)
+def get_validator():
+    """Returns the validator shared by the whole process."""
+    global _validator
+    with _validator_lock:
+        if _validator is None:
+            _validator = MetadataValidator(
+                cache_dir=os.environ.get('CBORGUPLOADER_CACHE_DIR'))
+    return _validator
 
-    shex = pkg_resources.resource_stream(__name__, "bh20seq-shex.rdf").read().decode("utf-8")
 
-    if not isinstance(avsc_names, schema_salad.avro.schema.Names):
-        print(avsc_names)
+def qc_metadata(metadatafile):
+    try:
+        validator = get_validator()
+    except ValueError as e:
+        print(e)
         return False
+    return validator.validate(metadatafile)
 
-    doc, metadata = schema_salad.schema.load_and_validate(document_loader, avsc_names, metadatafile, True)
-    doc["id"] = uri
-    return schema_salad.jsonld_context.makerdf("workflow", doc, document_loader.ctx)
+
+def to_rdf(uri, metadatafile):
+    return get_validator().to_rdf(uri, metadatafile)
@@ -0,0 +1,133 @@
+import hashlib
+import json
+import logging
+import os
+import time
+
+CHECKPOINT_DIR = os.path.join(
+    os.environ.get('CBORGUPLOADER_CACHE_DIR',
+                   os.path.expanduser('~/.cache/cborguploader')),
+    'uploads')
+
+
+# Checkpointed locators are signed and the signatures expire, after two
+# weeks with the default Keep configuration
+CHECKPOINT_MAX_AGE = 7 * 24 * 3600
+
+
+def sample_key(files, block_size):
+    """Returns a key for the local files of a sample.
+
+    files is a list of (role, filename) pairs. The key is made from the file
+    paths, sizes and modification times, so it is computed without reading
+    the files and changes when a file does.
+    """
+    key = hashlib.md5(str(block_size).encode('utf-8'))
+    for role, filename in sorted(files):
+        st = os.stat(filename)
+        key.update(json.dumps([
+            role, os.path.abspath(filename), st.st_size, st.st_mtime_ns,
+            st.st_ino]).encode('utf-8'))
+    return key.hexdigest()
+
+
+def content_digest(files, chunk_size=1 << 20):
+    """Returns a digest of the contents of the local files of a sample.
+
+    files is a list of (role, filename) pairs. The files are read in chunks
+    of chunk_size bytes, and the digest covers the role, size and contents
+    of each file, so it can be looked up before anything is uploaded.
+    """
+    digest = hashlib.sha256()
+    for role, filename in sorted(files):
+        size = 0
+        digest.update(role.encode('utf-8') + b'\0')
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                digest.update(chunk)
+                size += len(chunk)
+        digest.update(b'\0%d\0' % size)
+    return 'sha256:' + digest.hexdigest()
+
+
+def find_existing(api, owner_uuid, digest):
+    """Returns a collection in the project with the same content digest."""
+    items = api.collections().list(
+        filters=[["owner_uuid", "=", owner_uuid],
+                 ["properties.content_digest", "=", digest]],
+        limit=1).execute()['items']
+    if items:
+        return items[0]
+    return None
+
+
+class UploadCheckpoint(object):
+    """Progress of an upload, stored in a local JSON file.
+
+    While a file is written, the signed locators of its leading blocks that
+    are in Keep are saved, so that an interrupted upload continues with the
+    first missing block. Finished files are kept in the collection
+    manifest. Once the sample is uploaded only its content digest is kept,
+    which lets a later run find the collection without reading the files.
+    """
+
+    def __init__(self, key, checkpoint_dir=CHECKPOINT_DIR):
+        self.path = os.path.join(checkpoint_dir, key + '.json')
+        self.reset()
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+            self.digest = state.get('digest')
+            if (self.digest is None and time.time() - os.path.getmtime(
+                    self.path) > CHECKPOINT_MAX_AGE):
+                logging.warning('Ignoring expired checkpoint %s', self.path)
+                return
+            self.manifest_text = state.get('manifest_text')
+            self.files = state.get('files', {})
+            self.partial = state.get('partial', {})
+        except (ValueError, AttributeError) as e:
+            logging.warning('Ignoring broken checkpoint %s: %s',
+                            self.path, e)
+            self.reset()
+
+    def reset(self):
+        self.digest = None
+        self.manifest_text = None
+        self.files = {}
+        self.partial = {}
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'digest': self.digest,
+                       'manifest_text': self.manifest_text,
+                       'files': self.files, 'partial': self.partial}, f)
+        os.replace(tmp_path, self.path)
+
+    def resume_locators(self, role):
+        """Returns the locators of the blocks of role already in Keep."""
+        return self.partial.get(role, {}).get('locators', [])
+
+    def record_blocks(self, role, locators, size):
+        self.partial[role] = {'locators': locators, 'size': size}
+        self._save()
+
+    def record(self, role, filename_remote, manifest_text, locators,
+               stats=None):
+        self.files[role] = {'name': filename_remote, 'stats': stats,
+                            'locators': locators}
+        self.partial.pop(role, None)
+        self.manifest_text = manifest_text
+        self._save()
+
+    def complete(self, digest):
+        self.reset()
+        self.digest = digest
+        self._save()
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
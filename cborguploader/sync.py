@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+import click as ck
+import contextlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from cborguploader.metrics import count, reporting, span
+
+OUTBOX_PATH = os.path.join(
+    os.environ.get('CBORGUPLOADER_CACHE_DIR',
+                   os.path.expanduser('~/.cache/cborguploader')),
+    'sync-outbox.db')
+# Events sent per flush round and concurrent requests of a round
+SYNC_BATCH_SIZE = 50
+SYNC_WORKERS = 4
+SYNC_TIMEOUT = 10
+SYNC_MAX_ATTEMPTS = 10
+# Exponential backoff between attempts of an event, in seconds
+RETRY_BASE = 2.0
+RETRY_MAX = 600.0
+# Seconds a command waits at exit for queued events to be sent
+SYNC_EXIT_TIMEOUT = float(os.environ.get('CBORGUPLOADER_SYNC_EXIT_TIMEOUT', 10))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    url TEXT NOT NULL,
+    col_uuid TEXT NOT NULL UNIQUE,
+    data TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL DEFAULT 0,
+    last_error TEXT,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_due ON events (status, next_attempt);
+"""
+
+
+class SyncError(Exception):
+
+    def __init__(self, message, retryable=True):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+def backoff(attempts):
+    return min(RETRY_BASE * 2 ** (attempts - 1), RETRY_MAX)
+
+
+class SyncOutbox(object):
+    """Sync events for the web portal kept in a local SQLite database.
+
+    Events survive crashes and failed requests until they are sent. The
+    payload includes the API token, so the database is only readable by
+    its owner.
+    """
+
+    def __init__(self, path=OUTBOX_PATH):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        os.close(os.open(path, os.O_CREAT | os.O_WRONLY, 0o600))
+        self._lock = threading.RLock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def add(self, url, col_uuid, data):
+        """Queues an event, replacing an unsent one of the same collection."""
+        with self._lock, self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO events '
+                '(url, col_uuid, data, created_at) VALUES (?, ?, ?, ?)',
+                (url, col_uuid, json.dumps(data), time.time()))
+
+    def due(self, limit=SYNC_BATCH_SIZE):
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT * FROM events WHERE status = 'pending' "
+                'AND next_attempt <= ? ORDER BY id LIMIT ?',
+                (time.time(), limit)).fetchall()
+        return [dict(row) for row in rows]
+
+    def sent(self, event_id):
+        with self._lock, self.conn:
+            self.conn.execute('DELETE FROM events WHERE id = ?', (event_id,))
+
+    def retry_later(self, event, error, retryable=True):
+        """Schedules another attempt of an event, or marks it failed once
+        the error is permanent or it ran out of attempts."""
+        attempts = event['attempts'] + 1
+        status = 'pending'
+        if not retryable or attempts >= SYNC_MAX_ATTEMPTS:
+            status = 'failed'
+        with self._lock, self.conn:
+            self.conn.execute(
+                'UPDATE events SET status = ?, attempts = ?, '
+                'next_attempt = ?, last_error = ? WHERE id = ?',
+                (status, attempts, time.time() + backoff(attempts),
+                 str(error), event['id']))
+        return status
+
+    def next_attempt(self):
+        """Returns when the next pending event is due, or None."""
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT MIN(next_attempt) FROM events "
+                "WHERE status = 'pending'").fetchone()
+        return row[0]
+
+    def requeue_failed(self):
+        with self._lock, self.conn:
+            return self.conn.execute(
+                "UPDATE events SET status = 'pending', attempts = 0, "
+                "next_attempt = 0 WHERE status = 'failed'").rowcount
+
+    def counts(self):
+        with self._lock:
+            rows = self.conn.execute(
+                'SELECT status, COUNT(*) AS n FROM events '
+                'GROUP BY status').fetchall()
+        return {row['status']: row['n'] for row in rows}
+
+    def failed(self):
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT * FROM events WHERE status = 'failed' "
+                'ORDER BY id').fetchall()
+        return [dict(row) for row in rows]
+
+
+def make_session(workers=SYNC_WORKERS):
+    """Returns a requests session keeping one connection per worker."""
+    import requests
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=1, pool_maxsize=workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def post_event(session, event, timeout=SYNC_TIMEOUT):
+    """Sends one event. Raises SyncError if the portal did not accept it;
+    server errors, throttling and connection problems are retryable."""
+    import requests
+    try:
+        with span('web_sync'):
+            response = session.post(
+                event['url'], data=json.loads(event['data']), timeout=timeout)
+    except requests.RequestException as e:
+        raise SyncError(e)
+    if response.status_code >= 500 or response.status_code == 429:
+        raise SyncError('HTTP %d' % response.status_code)
+    if response.status_code >= 400:
+        raise SyncError('HTTP %d: %s' % (
+            response.status_code, response.text[:200]), retryable=False)
+
+
+def flush(outbox, session, batch_size=SYNC_BATCH_SIZE, workers=SYNC_WORKERS,
+          timeout=SYNC_TIMEOUT):
+    """Sends the due events in rounds of batch_size concurrent requests.
+
+    Returns the numbers of sent events and of events that failed.
+    """
+    def send(event):
+        try:
+            post_event(session, event, timeout)
+        except SyncError as e:
+            status = outbox.retry_later(event, e, e.retryable)
+            logging.warning('Sync of %s failed (%s), %s', event['col_uuid'],
+                            e, 'giving up' if status == 'failed'
+                            else 'will retry')
+            count('sync_events_failed')
+            return False
+        outbox.sent(event['id'])
+        count('sync_events_sent')
+        return True
+
+    sent = failed = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        events = outbox.due(batch_size)
+        while events:
+            for ok in executor.map(send, events):
+                sent += ok
+                failed += not ok
+            events = outbox.due(batch_size)
+    return sent, failed
+
+
+class SyncWorker(threading.Thread):
+    """Flushes an outbox in the background whenever events are queued."""
+
+    def __init__(self, outbox, session=None, interval=RETRY_BASE):
+        super().__init__(name='sync-worker', daemon=True)
+        self.outbox = outbox
+        self.session = session if session is not None else make_session()
+        self.interval = interval
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+
+    def notify(self):
+        self._wakeup.set()
+
+    def run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                flush(self.outbox, self.session)
+            except Exception:
+                logging.exception('Flushing the sync outbox failed')
+            if self._stopping.is_set():
+                return
+
+    def stop(self, timeout=SYNC_EXIT_TIMEOUT):
+        """Keeps sending events, including those waiting for a retry, until
+        none are pending or timeout seconds have passed."""
+        deadline = time.monotonic() + timeout
+        self._stopping.set()
+        self._wakeup.set()
+        self.join(timeout)
+        while not self.is_alive():
+            next_attempt = self.outbox.next_attempt()
+            if next_attempt is None:
+                break
+            delay = next_attempt - time.time()
+            if delay > deadline - time.monotonic():
+                break
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                flush(self.outbox, self.session, timeout=max(
+                    0.1, min(SYNC_TIMEOUT, deadline - time.monotonic())))
+            except Exception:
+                logging.exception('Flushing the sync outbox failed')
+                break
+        pending = self.outbox.counts().get('pending', 0)
+        if pending:
+            logging.warning(
+                '%d web sync events are still queued in %s, they will be '
+                'sent by the next run or by cborguploader-sync',
+                pending, self.outbox.path)
+
+
+_outbox = None
+_worker = None
+_outbox_lock = threading.Lock()
+
+
+def default_outbox():
+    global _outbox
+    with _outbox_lock:
+        if _outbox is None:
+            _outbox = SyncOutbox()
+        return _outbox
+
+
+def enqueue(url, col_uuid, data):
+    """Queues a sync event and wakes the background worker, if running.
+
+    Returns without waiting for the portal.
+    """
+    default_outbox().add(url, col_uuid, data)
+    if _worker is not None:
+        _worker.notify()
+
+
+@contextlib.contextmanager
+def background_sync(enabled=True, timeout=SYNC_EXIT_TIMEOUT):
+    """Runs a SyncWorker on the default outbox while the block runs.
+
+    Events left from earlier runs are sent as well.
+    """
+    global _worker
+    if not enabled:
+        yield
+        return
+    _worker = SyncWorker(default_outbox())
+    _worker.start()
+    _worker.notify()
+    try:
+        yield
+    finally:
+        worker, _worker = _worker, None
+        worker.stop(timeout)
+
+
+@ck.command()
+@ck.option('--retry-failed', '-rf', is_flag=True, help='Also resend events that ran out of attempts or were rejected')
+@ck.option('--list-failed', '-lf', is_flag=True, help='Print the events that failed permanently')
+@ck.option('--metrics-out', default=None, help='Write stage timings and counters to this file, as a Prometheus textfile if it ends with .prom and JSON otherwise')
+def main(retry_failed, list_failed, metrics_out):
+    """Sends the queued web sync events of earlier uploads."""
+    outbox = default_outbox()
+    if list_failed:
+        for event in outbox.failed():
+            print('%s\t%d\t%s' % (
+                event['col_uuid'], event['attempts'], event['last_error']))
+        return
+    if retry_failed:
+        outbox.requeue_failed()
+    with reporting(metrics_out):
+        sent, failed = flush(outbox, make_session())
+    counts = outbox.counts()
+    print('Sent %d events, %d failed, %d pending, %d failed permanently' % (
+        sent, failed, counts.get('pending', 0), counts.get('failed', 0)))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,45 +1,139 @@
 #!/usr/bin/env python
 
 import click as ck
-import openpyxl
+import csv
+import datetime
+import os
 import yaml
 
+from cborguploader.manifest import MANIFEST_COLUMNS
+
+Dumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+
+def cell_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, datetime.datetime):
+        return value.date().isoformat()
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    return str(value).strip()
+
+
+def relative_path(path, start, base=''):
+    """Makes a path relative to the manifest, which is how it is read.
+
+    Relative paths are taken relative to base.
+    """
+    if not path:
+        return ''
+    return os.path.relpath(os.path.abspath(os.path.join(base, path)), start)
+
+
+def read_rows(input_file):
+    """Yields the row numbers and rows of an excel sheet or CSV file as
+    dicts. The header is row 1."""
+    if input_file.endswith('.csv'):
+        with open(input_file, newline='') as f:
+            reader = csv.reader(f)
+            header = [h.strip(' :') for h in next(reader)]
+            for number, row in enumerate(reader, 2):
+                if any(v.strip() for v in row):
+                    yield number, dict(zip(header, (v.strip() for v in row)))
+        return
+    import openpyxl
+    wb = openpyxl.load_workbook(input_file, read_only=True, data_only=True)
+    try:
+        rows = wb.active.iter_rows(values_only=True)
+        header = [cell_value(h).strip(' :') for h in next(rows)]
+        for number, row in enumerate(rows, 2):
+            values = [cell_value(v) for v in row]
+            if any(values):
+                yield number, dict(zip(header, values))
+    finally:
+        wb.close()
+
+
+def make_metadata(template, item):
+    # Only the sections that are filled in are copied, the rest of the
+    # template is shared between documents
+    metadata = dict(template)
+    metadata['host'] = dict(template['host'])
+    metadata['sample'] = dict(template['sample'])
+    metadata['host']['host_id'] = item['host_id']
+    metadata['sample']['sample_id'] = item['sample_id']
+    metadata['sample']['collection_date'] = item['collection_date']
+    metadata['sample']['collection_location'] = 'http://www.wikidata.org/entity/' + item['collection_location']
+    metadata['sample']['specimen_source'] = ['http://purl.obolibrary.org/obo/NCIT_' + item['specimen_source']]
+    return metadata
+
 
 @ck.command()
 @ck.option(
     '--input-file', '-i', default='metadata.xlsx',
-    help='Metadata in excel sheet')
+    help='Metadata in excel sheet or CSV file')
 @ck.option(
     '--metadata-file', '-mf', default='example/metadata.yaml',
     help='The directory to output the metadata')
 @ck.option(
     '--output-dir', '-o', default='metadata/',
     help='The directory to output the metadata')
-def main(input_file, metadata_file, output_dir):
-    wb = openpyxl.load_workbook(input_file) 
-    sheet = wb.active 
-
-    header = []
-    for i in range(1, sheet.max_column + 1):
-        cell = sheet.cell(row=1, column=i)
-        header.append(cell.value.strip(' :'))
-    data = []
-    for i in range(1, sheet.max_row):
-        item = {}
-        for j in range(sheet.max_column):
-            item[header[j]] = sheet.cell(row=i+1, column=j+1).value.strip()
-        data.append(item)
-
-    min_metadata = yaml.load(open(metadata_file), Loader=yaml.FullLoader)
-    for item in data:
-        metadata = min_metadata.copy()
-        metadata['host']['host_id'] = item['host_id']
-        metadata['sample']['sample_id'] = item['sample_id']
-        metadata['sample']['collection_date'] = item['collection_date']
-        metadata['sample']['collection_location'] = 'http://www.wikidata.org/entity/' + item['collection_location']
-        metadata['sample']['specimen_source'] = ['http://purl.obolibrary.org/obo/NCIT_' + item['specimen_source']]
-        with open(output_dir + item['sample_id'] + '.yaml', 'w') as f:
-            yaml.dump(metadata, f)
+@ck.option(
+    '--validate', '-v', is_flag=True,
+    help='Validate every metadata file against the schema')
+@ck.option(
+    '--manifest', '-m', default=None,
+    help='Write a manifest for cborguploader-batch. fasta, read1 and read2 '
+    'columns of the input are copied into it')
+def main(input_file, metadata_file, output_dir, validate, manifest):
+    with open(metadata_file) as f:
+        template = yaml.load(f, Loader=yaml.FullLoader)
+    validator = None
+    if validate:
+        from cborguploader.qc_metadata import get_validator
+        validator = get_validator()
+    os.makedirs(output_dir, exist_ok=True)
+
+    manifest_file = None
+    if manifest is not None:
+        manifest_file = open(manifest, 'w', newline='')
+        writer = csv.writer(
+            manifest_file,
+            delimiter=',' if manifest.endswith('.csv') else '\t')
+        writer.writerow(MANIFEST_COLUMNS)
+        manifest_dir = os.path.dirname(os.path.abspath(manifest))
+    # Paths in the sheet are relative to the sheet
+    input_dir = os.path.dirname(input_file)
+    rows_by_id = {}
+    total = failed = 0
+    try:
+        for number, item in read_rows(input_file):
+            if item['sample_id'] in rows_by_id:
+                raise ck.ClickException(
+                    'Row %d: sample_id %s is already used in row %d' % (
+                        number, item['sample_id'],
+                        rows_by_id[item['sample_id']]))
+            rows_by_id[item['sample_id']] = number
+            total += 1
+            filename = os.path.join(output_dir, item['sample_id'] + '.yaml')
+            with open(filename, 'w') as f:
+                yaml.dump(make_metadata(template, item), f, Dumper=Dumper)
+            if validator is not None and not validator.validate(filename):
+                print('Metadata validation failed for ' + filename)
+                failed += 1
+                continue
+            if manifest_file is not None:
+                writer.writerow(
+                    [item['sample_id'], relative_path(filename, manifest_dir)]
+                    + [relative_path(item.get(key), manifest_dir, input_dir)
+                       for key in MANIFEST_COLUMNS[2:]])
+    finally:
+        if manifest_file is not None:
+            manifest_file.close()
+    if validator is not None:
+        print(f'{total - failed} of {total} metadata files are valid')
+
 
 if __name__ == '__main__':
     main()
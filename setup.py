@@ -45,15 +45,19 @@ setup(
                                       "options.yml",
                                       "shex.rdf",
                                       "validation/formats",
+                                      "validation/formats.mgc",
                                       "SARS-CoV-2-reference.fasta",],
     },
     install_requires=install_requires,
-    extras_require={},
+    extras_require={"zstd": ["zstandard"]},
     setup_requires=setup_requires + pytest_runner,
     tests_require=["pytest<5"],
     entry_points={
         "console_scripts": [
             "cborguploader=cborguploader.main:main",
+            "cborguploader-batch=cborguploader.batch:main",
+            "cborguploader-multifasta=cborguploader.multifasta:main",
+            "cborguploader-sync=cborguploader.sync:main",
         ]
     },
     zip_safe=True,
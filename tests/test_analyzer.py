@@ -0,0 +1,78 @@
+import pytest
+
+pytest.importorskip('arvados')
+
+from benchmarks.fake_arvados import FakeApi, add_uploads  # noqa: E402
+from benchmarks.run import analyzer_module  # noqa: E402
+
+analyzer, state = analyzer_module()
+import pipeline  # noqa: E402
+
+
+@pytest.fixture
+def api():
+    return FakeApi()
+
+
+@pytest.fixture
+def project(api):
+    return api.create('groups', {'name': 'uploads'})['uuid']
+
+
+@pytest.fixture
+def store(tmp_path):
+    with state.StateStore(str(tmp_path / 'state.db')) as store:
+        yield store
+
+
+def list_new(api, project, store, page_size=2):
+    reads = pipeline.list_new_reads(
+        api, project, store.get_meta('last_modified_at'),
+        store.get_meta('last_uuid'), page_size=page_size)
+    pipeline.register_reads(store, reads)
+    return [it['properties']['sequence_label'] for it in reads]
+
+
+def test_pages_by_key(api, project, store):
+    add_uploads(api, project, 7)
+    # Collections modified at the same time are paged by uuid
+    records = list(api.records['collections'].values())
+    for record in records[2:5]:
+        record['modified_at'] = records[4]['modified_at']
+    assert sorted(list_new(api, project, store)) == sorted(
+        'sample%d' % (i + 1) for i in range(7))
+    assert list_new(api, project, store) == []
+    add_uploads(api, project, 1, start=7)
+    assert list_new(api, project, store) == ['sample8']
+
+
+def test_resumes_within_equal_times(api, project, store):
+    add_uploads(api, project, 4)
+    uuids = list(api.records['collections'])
+    for uuid in uuids:
+        api.records['collections'][uuid]['modified_at'] = '2020-01-01T00:00:00Z'
+    store.set_meta('last_modified_at', '2020-01-01T00:00:00Z')
+    store.set_meta('last_uuid', uuids[1])
+    assert list_new(api, project, store) == ['sample3', 'sample4']
+
+
+def test_failed_listing_keeps_mark(api, project, store, monkeypatch):
+    add_uploads(api, project, 3)
+    list_new(api, project, store)
+    mark = store.get_meta('last_modified_at'), store.get_meta('last_uuid')
+    add_uploads(api, project, 3, start=3)
+    list_ = api.collections().list
+    calls = []
+
+    def failing_list(**kwargs):
+        calls.append(kwargs)
+        if len(calls) > 1:
+            raise IOError('API is down')
+        return list_(**kwargs)
+
+    monkeypatch.setattr(api, 'collections', lambda: type(
+        'Collections', (), {'list': staticmethod(failing_list)})())
+    with pytest.raises(IOError):
+        list_new(api, project, store)
+    assert (store.get_meta('last_modified_at'),
+            store.get_meta('last_uuid')) == mark
@@ -0,0 +1,28 @@
+import importlib.util
+import json
+
+import pytest
+from click.testing import CliRunner
+
+from benchmarks.run import SUITES, main
+
+# Suites that drive the Arvados SDK against the fake API
+NEEDS_ARVADOS = {'upload', 'analyzer'}
+SMALLEST = ['--sizes', '10', '--depth', '1', '--genomes', '2',
+            '--qc-genomes', '1', '--substitution-rates', '0.001',
+            '--keep-latency', '0', '--put-threads', '1', '--sync-events', '5',
+            '--portal-latency', '0', '--repeat', '1']
+
+
+@pytest.mark.parametrize('suite', SUITES)
+def test_suite_runs(suite, tmp_path):
+    if (suite in NEEDS_ARVADOS
+            and importlib.util.find_spec('arvados') is None):
+        pytest.skip('arvados is not installed')
+    output = str(tmp_path / 'results.json')
+    result = CliRunner().invoke(main, [
+        'run', '--suites', suite, '--workdir', str(tmp_path / 'work'),
+        '--output', output] + SMALLEST)
+    assert result.exit_code == 0, result.output
+    with open(output) as f:
+        assert json.load(f)['results']
@@ -0,0 +1,173 @@
+import io
+import os
+
+import pytest
+
+from cborguploader.blockwriter import EMPTY_LOCATOR, BlockWriter, LocalKeep
+from cborguploader.resume import UploadCheckpoint
+
+BLOCK_SIZE = 1000
+
+
+class BytesKeep(LocalKeep):
+    """Keep client that, like KeepClient, only takes bytes."""
+
+    accepts_buffers = False
+
+    def __init__(self):
+        super().__init__()
+        self.puts = 0
+
+    def put(self, data, copies=None):
+        assert isinstance(data, bytes)
+        self.puts += 1
+        return super().put(data, copies)
+
+
+class FailingKeep(LocalKeep):
+    """Keep client that fails after a number of puts."""
+
+    def __init__(self, failing_after=0):
+        super().__init__()
+        self.failing_after = failing_after
+
+    def put(self, data, copies=None):
+        if len(self.blocks) >= self.failing_after:
+            raise IOError('Keep is down')
+        return super().put(data, copies)
+
+
+@pytest.fixture
+def data():
+    return os.urandom(3 * BLOCK_SIZE + 123)
+
+
+@pytest.fixture
+def path(tmp_path, data):
+    path = tmp_path / 'reads.fastq'
+    path.write_bytes(data)
+    return str(path)
+
+
+def parse(manifest):
+    stream, *tokens = manifest.split()
+    assert stream == '.'
+    start, size, name = tokens[-1].split(':', 2)
+    assert start == '0'
+    return tokens[:-1], int(size), name
+
+
+def read(keep, locators):
+    return b''.join(keep.get(locator) for locator in locators)
+
+
+@pytest.mark.parametrize('keep_class', [LocalKeep, BytesKeep])
+@pytest.mark.parametrize('from_path', [True, False])
+def test_round_trip(keep_class, from_path, path, data):
+    keep = keep_class()
+    source = path if from_path else io.BytesIO(data)
+    manifest = BlockWriter(keep, 2, BLOCK_SIZE).write(source, 'reads.fastq',
+                                                      out=None)
+    locators, size, name = parse(manifest)
+    assert name == 'reads.fastq'
+    assert size == len(data)
+    assert len(locators) == 4
+    assert read(keep, locators) == data
+
+
+def test_empty_file(tmp_path):
+    path = tmp_path / 'empty'
+    path.write_bytes(b'')
+    manifest = BlockWriter(LocalKeep(), 2, BLOCK_SIZE).write(
+        str(path), 'empty', out=None)
+    assert parse(manifest) == ([EMPTY_LOCATOR], 0, 'empty')
+
+
+def test_name_is_escaped(path):
+    manifest = BlockWriter(LocalKeep(), 2, BLOCK_SIZE).write(
+        path, 'my reads.fastq', out=None)
+    assert parse(manifest)[2] == 'my\\040reads.fastq'
+
+
+def test_validator_sees_every_byte_in_order(path, data):
+    chunks = []
+    BlockWriter(LocalKeep(), 2, BLOCK_SIZE).write(
+        path, 'reads.fastq', validator=lambda chunk: chunks.append(
+            bytes(chunk)), out=None)
+    assert b''.join(chunks) == data
+
+
+def test_validator_error_stops_upload(path):
+    def validator(chunk):
+        raise ValueError('bad chunk')
+
+    keep = LocalKeep()
+    with pytest.raises(ValueError, match='bad chunk'):
+        BlockWriter(keep, 2, BLOCK_SIZE).write(
+            path, 'reads.fastq', validator=validator, out=None)
+    assert keep.blocks == {}
+
+
+def test_put_error_is_raised(path):
+    with pytest.raises(IOError, match='Keep is down'):
+        BlockWriter(FailingKeep(), 2, BLOCK_SIZE).write(
+            path, 'reads.fastq', out=None)
+
+
+def test_committed_reports_leading_blocks(path, data):
+    calls = []
+    manifest = BlockWriter(LocalKeep(), 2, BLOCK_SIZE).write(
+        path, 'reads.fastq', out=None,
+        committed=lambda locators, size: calls.append((locators, size)))
+    locators, size, _ = parse(manifest)
+    assert calls[-1] == (locators, size)
+    for committed_locators, committed_size in calls:
+        assert committed_locators == locators[:len(committed_locators)]
+        assert committed_size == min(
+            len(committed_locators) * BLOCK_SIZE, len(data))
+
+
+def test_resume_skips_written_blocks(path, data):
+    keep = BytesKeep()
+    writer = BlockWriter(keep, 2, BLOCK_SIZE)
+    manifest = writer.write(path, 'reads.fastq', out=None)
+    locators = parse(manifest)[0]
+    keep.puts = 0
+    chunks = []
+    resumed = writer.write(
+        path, 'reads.fastq', out=None, resume=locators[:2],
+        validator=lambda chunk: chunks.append(bytes(chunk)))
+    assert resumed == manifest
+    assert keep.puts == 2
+    assert b''.join(chunks) == data
+
+
+def test_resume_from_partial_checkpoint(tmp_path, path, data):
+    checkpoint_dir = str(tmp_path / 'checkpoints')
+    checkpoint = UploadCheckpoint('sample', checkpoint_dir)
+    failing = FailingKeep(failing_after=2)
+    with pytest.raises(IOError, match='Keep is down'):
+        BlockWriter(failing, 1, BLOCK_SIZE).write(
+            path, 'reads.fastq', out=None,
+            committed=lambda locators, size: checkpoint.record_blocks(
+                'reads1', locators, size))
+
+    checkpoint = UploadCheckpoint('sample', checkpoint_dir)
+    resume = checkpoint.resume_locators('reads1')
+    assert len(resume) == 2
+    assert checkpoint.partial['reads1']['size'] == 2 * BLOCK_SIZE
+    keep = BytesKeep()
+    keep.blocks.update(failing.blocks)
+    manifest = BlockWriter(keep, 2, BLOCK_SIZE).write(
+        path, 'reads.fastq', out=None, resume=resume)
+    locators, size, _ = parse(manifest)
+    assert locators[:2] == resume
+    assert keep.puts == 2
+    assert read(keep, locators) == data
+
+
+def test_block_size_is_checked():
+    with pytest.raises(ValueError):
+        BlockWriter(LocalKeep(), block_size=0)
+    with pytest.raises(ValueError):
+        BlockWriter(LocalKeep(), block_size=(64 << 20) + 1)
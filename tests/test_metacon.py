@@ -0,0 +1,54 @@
+import csv
+import os
+
+from click.testing import CliRunner
+
+import metacon
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEMPLATE = os.path.join(ROOT, 'example', 'metadata.yaml')
+HEADER = ['sample_id', 'host_id', 'collection_date', 'collection_location',
+          'specimen_source', 'fasta']
+
+
+def write_sheet(path, rows):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(HEADER)
+        writer.writerows(rows)
+
+
+def row(sample_id, fasta=''):
+    return [sample_id, 'host', '2020-03-01', 'Q1', 'C155831', fasta]
+
+
+def run(sheet, tmp_path):
+    manifest = str(tmp_path / 'out' / 'manifest.tsv')
+    os.makedirs(os.path.dirname(manifest), exist_ok=True)
+    result = CliRunner().invoke(metacon.main, [
+        '-i', sheet, '-mf', TEMPLATE, '-o', str(tmp_path / 'out' / 'meta'),
+        '-m', manifest])
+    return result, manifest
+
+
+def test_paths_are_relative_to_sheet(tmp_path):
+    os.makedirs(tmp_path / 'sheets' / 'seqs')
+    sheet = str(tmp_path / 'sheets' / 'samples.csv')
+    write_sheet(sheet, [row('s1', 'seqs/s1.fasta'), row('s2')])
+    result, manifest = run(sheet, tmp_path)
+    assert result.exit_code == 0, result.output
+    with open(manifest) as f:
+        rows = list(csv.DictReader(f, delimiter='\t'))
+    assert [r['sample'] for r in rows] == ['s1', 's2']
+    assert rows[0]['fasta'] == os.path.join(
+        '..', 'sheets', 'seqs', 's1.fasta')
+    assert rows[0]['metadata'] == os.path.join('meta', 's1.yaml')
+    assert rows[1]['fasta'] == ''
+
+
+def test_duplicate_sample_ids_are_rejected(tmp_path):
+    sheet = str(tmp_path / 'samples.csv')
+    write_sheet(sheet, [row('s1'), [''] * len(HEADER), row('s2'), row('s1')])
+    result, _ = run(sheet, tmp_path)
+    assert result.exit_code != 0
+    assert 'Row 5: sample_id s1 is already used in row 2' in result.output
@@ -0,0 +1,57 @@
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+pytest.importorskip('schema_salad')
+pytest.importorskip('pyshex')
+
+from cborguploader.qc_metadata import MetadataValidator  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EXAMPLE = os.path.join(ROOT, 'example', 'metadata.yaml')
+
+
+@pytest.fixture(scope='module')
+def validator():
+    return MetadataValidator()
+
+
+def test_example_is_valid(validator):
+    assert validator.validate(EXAMPLE)
+
+
+def test_changed_file_is_read_again(validator, tmp_path):
+    path = str(tmp_path / 'metadata.yaml')
+    shutil.copyfile(EXAMPLE, path)
+    assert validator.validate(path)
+    with open(path, 'w') as f:
+        f.write('foo: bar\n')
+    assert not validator.validate(path)
+
+
+def test_loaded_documents_are_not_kept(validator, tmp_path):
+    indexed = len(validator.document_loader.idx)
+    path = str(tmp_path / 'metadata.yaml')
+    shutil.copyfile(EXAMPLE, path)
+    validator.to_rdf('http://example.org/sample1', path)
+    assert len(validator.document_loader.idx) == indexed
+
+
+def from_cache(cache_dir):
+    return subprocess.check_output(
+        [sys.executable, '-c',
+         'from cborguploader.qc_metadata import MetadataValidator; '
+         'v = MetadataValidator(%r); '
+         'print(v.from_cache, v.validate(%r))' % (cache_dir, EXAMPLE)],
+        cwd=ROOT).decode('utf-8').split()[-2:]
+
+
+def test_schema_cache_is_reused_by_other_processes(tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    assert from_cache(cache_dir) == ['False', 'True']
+    assert from_cache(cache_dir) == ['True', 'True']
+    assert [name for name in os.listdir(cache_dir)
+            if not name.endswith('.pickle')] == []
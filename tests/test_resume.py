@@ -0,0 +1,30 @@
+from cborguploader.resume import content_digest
+
+
+def write(tmp_path, name, data):
+    path = tmp_path / name
+    path.write_bytes(data)
+    return str(path)
+
+
+def test_digest_depends_on_contents_and_roles(tmp_path):
+    reads = write(tmp_path, 'a.fastq', b'@r\nACGT\n+\nIIII\n')
+    metadata = write(tmp_path, 'a.yaml', b'id: a\n')
+    digest = content_digest([('reads1', reads), ('metadata', metadata)])
+    assert digest.startswith('sha256:')
+    assert content_digest(
+        [('metadata', metadata), ('reads1', reads)]) == digest
+    assert content_digest(
+        [('reads2', reads), ('metadata', metadata)]) != digest
+    copy = write(tmp_path, 'b.fastq', b'@r\nACGT\n+\nIIII\n')
+    assert content_digest(
+        [('reads1', copy), ('metadata', metadata)]) == digest
+    write(tmp_path, 'a.fastq', b'@r\nACGA\n+\nIIII\n')
+    assert content_digest(
+        [('reads1', reads), ('metadata', metadata)]) != digest
+
+
+def test_digest_does_not_depend_on_chunk_size(tmp_path):
+    reads = write(tmp_path, 'a.fastq', bytes(range(256)) * 10)
+    assert (content_digest([('reads1', reads)], chunk_size=7)
+            == content_digest([('reads1', reads)]))
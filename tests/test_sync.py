@@ -0,0 +1,106 @@
+import pytest
+
+from benchmarks.fake_portal import SYNC_PATH, FakePortal
+from cborguploader import sync
+from cborguploader.sync import SyncOutbox, SyncWorker, flush, make_session
+
+
+@pytest.fixture
+def outbox(tmp_path):
+    with SyncOutbox(str(tmp_path / 'outbox.db')) as outbox:
+        yield outbox
+
+
+@pytest.fixture
+def portal():
+    with FakePortal() as portal:
+        yield portal
+
+
+def event(col_uuid):
+    return {'token': 'secret', 'col_uuid': col_uuid, 'status': 'uploaded'}
+
+
+def test_flush_sends_events(outbox, portal):
+    for i in range(3):
+        outbox.add(portal.url, 'col%d' % i, event('col%d' % i))
+    assert flush(outbox, make_session()) == (3, 0)
+    assert sorted(e['col_uuid'] for e in portal.received) == [
+        'col0', 'col1', 'col2']
+    assert outbox.counts() == {}
+
+
+def test_add_replaces_unsent_event(outbox, portal):
+    outbox.add(portal.url, 'col', dict(event('col'), status='first'))
+    outbox.add(portal.url, 'col', event('col'))
+    assert flush(outbox, make_session()) == (1, 0)
+    assert portal.received == [event('col')]
+
+
+def test_server_errors_are_retried(outbox, portal, monkeypatch):
+    monkeypatch.setattr(sync, 'RETRY_BASE', 0.0)
+    portal.error_rate = 1.0
+    outbox.add(portal.url, 'col', event('col'))
+    monkeypatch.setattr(sync, 'SYNC_MAX_ATTEMPTS', 3)
+    assert flush(outbox, make_session()) == (0, 3)
+    assert outbox.counts() == {'failed': 1}
+    assert outbox.failed()[0]['last_error'] == 'HTTP 503'
+    portal.error_rate = 0.0
+    assert outbox.requeue_failed() == 1
+    assert flush(outbox, make_session()) == (1, 0)
+    assert portal.received == [event('col')]
+
+
+def test_retries_wait_for_backoff(outbox, portal, monkeypatch):
+    monkeypatch.setattr(sync, 'RETRY_BASE', 60.0)
+    portal.error_rate = 1.0
+    outbox.add(portal.url, 'col', event('col'))
+    assert flush(outbox, make_session()) == (0, 1)
+    portal.error_rate = 0.0
+    assert flush(outbox, make_session()) == (0, 0)
+    assert outbox.counts() == {'pending': 1}
+    assert portal.requests == 1
+
+
+def test_client_errors_are_permanent(outbox, portal):
+    url = portal.url.replace(SYNC_PATH, '/api/uploader/missing')
+    outbox.add(url, 'col', event('col'))
+    assert flush(outbox, make_session()) == (0, 1)
+    assert outbox.counts() == {'failed': 1}
+    assert outbox.failed()[0]['last_error'].startswith('HTTP 404')
+    assert portal.requests == 1
+
+
+def test_connection_errors_are_retried(outbox, monkeypatch):
+    monkeypatch.setattr(sync, 'RETRY_BASE', 60.0)
+    with FakePortal() as portal:
+        url = portal.url
+    outbox.add(url, 'col', event('col'))
+    assert flush(outbox, make_session(), timeout=1) == (0, 1)
+    assert outbox.counts() == {'pending': 1}
+
+
+def test_stop_sends_events_waiting_for_retry(outbox, portal, monkeypatch):
+    monkeypatch.setattr(sync, 'RETRY_BASE', 0.2)
+    portal.error_rate = 1.0
+    outbox.add(portal.url, 'col', event('col'))
+    assert flush(outbox, make_session()) == (0, 1)
+    portal.error_rate = 0.0
+    worker = SyncWorker(outbox, make_session())
+    worker.start()
+    worker.stop(timeout=5)
+    assert not worker.is_alive()
+    assert outbox.counts() == {}
+    assert portal.received == [event('col')]
+
+
+def test_stop_leaves_events_due_after_timeout(outbox, portal, monkeypatch):
+    monkeypatch.setattr(sync, 'RETRY_BASE', 60.0)
+    portal.error_rate = 1.0
+    outbox.add(portal.url, 'col', event('col'))
+    assert flush(outbox, make_session()) == (0, 1)
+    worker = SyncWorker(outbox, make_session())
+    worker.start()
+    worker.stop(timeout=0.5)
+    assert outbox.counts() == {'pending': 1}
+    assert portal.requests == 1
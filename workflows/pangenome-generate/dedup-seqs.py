@@ -0,0 +1,109 @@
+import argparse
+import hashlib
+
+# Removes duplicate sequences from a FASTA file, ignoring case. Writes the
+# first occurrence of every sequence to readsMergeDedup.fasta and the
+# duplicate groups to dups.txt in the format of `seqkit rmdup -D`.
+#
+# The digest, first subject and source of every unique sequence are kept
+# in an index (digest, subject, source) that can be passed to the next run,
+# together with the sources of the subjects of this run from
+# relabel-seqs.py. A sequence is only hashed again if its subject has a
+# different source than in the index, because the sample was uploaded
+# again, or no known source. Subjects without a source entry come from the
+# previous output an incremental run extends, which the index describes.
+
+def read_index(path):
+    """Returns the (digest, source) of the first subjects of an index."""
+    known = {}
+    with open(path, "rt") as f:
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) == 3:
+                digest, subject, source = fields
+                known[subject] = (digest, source)
+    return known
+
+def read_sources(path):
+    sources = {}
+    with open(path, "rt") as f:
+        for line in f:
+            subject, source = line.rstrip("\n").split("\t")
+            sources[subject] = source
+    return sources
+
+def records(fa):
+    header = None
+    lines = []
+    for line in fa:
+        if line.startswith(">"):
+            if header is not None:
+                yield header, lines
+            header = line
+            lines = []
+        else:
+            lines.append(line)
+    if header is not None:
+        yield header, lines
+
+def digest_of(lines):
+    h = hashlib.blake2b(digest_size=16)
+    for line in lines:
+        h.update("".join(line.split()).upper().encode("utf-8"))
+    return h.hexdigest()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("readsFA")
+    parser.add_argument("previousIndex", nargs="?",
+                        help="dedupIndex.tsv of a previous run")
+    parser.add_argument("--sources",
+                        help="sources.tsv of relabel-seqs.py, the previous "
+                        "index is not used without it")
+    args = parser.parse_args()
+
+    known = {}
+    sources = {}
+    if args.sources:
+        sources = read_sources(args.sources)
+        if args.previousIndex:
+            known = read_index(args.previousIndex)
+
+    groups = {}
+    group_sources = {}
+    with open(args.readsFA, "rt") as fa, \
+            open("readsMergeDedup.fasta", "wt") as out:
+        for header, lines in records(fa):
+            subject = header[1:].split()[0] if header[1:].strip() else ""
+            digest = None
+            if subject in known:
+                indexed_digest, indexed_source = known[subject]
+                source = sources.get(subject, indexed_source)
+                if source and source == indexed_source:
+                    digest = indexed_digest
+            else:
+                source = sources.get(subject, "")
+            if digest is None:
+                digest = digest_of(lines)
+            if digest in groups:
+                groups[digest].append(subject)
+                continue
+            groups[digest] = [subject]
+            group_sources[digest] = source
+            out.write(header)
+            out.writelines(lines)
+            if lines and not lines[-1].endswith("\n"):
+                out.write("\n")
+
+    with open("dedupIndex.tsv", "wt") as index_out:
+        for digest, subjects in groups.items():
+            index_out.write("%s\t%s\t%s\n" % (
+                digest, subjects[0], group_sources[digest]))
+
+    with open("dups.txt", "wt") as dups:
+        for subjects in groups.values():
+            if len(subjects) > 1:
+                dups.write("%d\t%s\n" % (len(subjects), ", ".join(subjects)))
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,5 @@
+import argparse
+import hashlib
 import re
 import schema_salad.schema
 import schema_salad.jsonld_context
@@ -5,12 +7,13 @@ import json
 import sys
 import os
 import logging
+import shutil
+import sqlite3
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
-metadataSchema = sys.argv[1]
-originalLabels = sys.argv[2]
-dups = None
-if len(sys.argv) == 4:
-    dups = sys.argv[3]
+# Documents queued per worker process, ahead of the one being written
+QUEUED_PER_JOB = 4
 
 def readitems(stem):
     items = []
@@ -21,29 +24,115 @@ def readitems(stem):
         b += 1
     return items
 
-metadata = readitems("block")
-subjects = readitems("subs")
-
-(document_loader,
- avsc_names,
- schema_metadata,
- metaschema_loader) = schema_salad.schema.load_schema(metadataSchema)
-
-for i, m in enumerate(metadata):
-    doc, metadata = schema_salad.schema.load_and_validate(document_loader, avsc_names, m["path"], False, False)
-    doc["id"] = subjects[i]
-    g = schema_salad.jsonld_context.makerdf(subjects[i], doc, document_loader.ctx)
-    print(g.serialize(format="ntriples").decode("utf-8"))
-
-if dups:
-    sameseqs = open(dups, "rt")
-    for d in sameseqs:
-        logging.warn(d)
-        g = re.match(r"\d+\t(.*)", d)
-        logging.warn("%s", g.group(1))
-        sp = g.group(1).split(",")
-        for n in sp[1:]:
-            print("<%s> <http://biohackathon.org/bh20-seq-schema/has_duplicate_sequence> <%s> ." % (n.strip(), sp[0].strip()))
-
-orig = open(originalLabels, "rt")
-print(orig.read())
+def sample_items(samples, subject_base):
+    """Returns the metadata files and subjects of the genomes of a
+    pangenome input directory, listed like relabel-seqs.py does."""
+    metadata = []
+    subjects = []
+    for name in sorted(os.listdir(samples)):
+        path = os.path.join(samples, name, "metadata.yaml")
+        if (os.path.isfile(path) and
+                os.path.isfile(os.path.join(samples, name, "sequence.fasta"))):
+            metadata.append({"path": path})
+            subjects.append(subject_base + name)
+    return metadata, subjects
+
+# Loaded once in every worker process
+document_loader = None
+avsc_names = None
+
+def init_worker(schema):
+    global document_loader, avsc_names
+    (document_loader,
+     avsc_names,
+     schema_metadata,
+     metaschema_loader) = schema_salad.schema.load_schema(schema)
+
+def makerdf(path, subject):
+    doc, metadata = schema_salad.schema.load_and_validate(document_loader, avsc_names, path, False, False)
+    doc["id"] = subject
+    g = schema_salad.jsonld_context.makerdf(subject, doc, document_loader.ctx)
+    return g.serialize(format="ntriples").decode("utf-8")
+
+def cache_key(schema_hash, path, subject):
+    h = hashlib.sha256(schema_hash.encode("utf-8"))
+    with open(path, "rb") as f:
+        h.update(f.read())
+    h.update(subject.encode("utf-8"))
+    return h.hexdigest()
+
+def write_rdf(cache, key, future, nt):
+    if future is not None:
+        nt = future.result()
+        cache.execute("INSERT OR REPLACE INTO rdf (key, nt) VALUES (?, ?)", (key, nt))
+    sys.stdout.write(nt)
+    sys.stdout.write("\n")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("metadataSchema")
+    parser.add_argument("originalLabels")
+    parser.add_argument("dups", nargs="?")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(),
+                        help="Number of worker processes")
+    parser.add_argument("--previous-cache",
+                        help="RDF cache database of a previous run")
+    parser.add_argument("--cache", default="rdfCache.sqlite",
+                        help="RDF cache database to write")
+    parser.add_argument("--samples",
+                        help="Pangenome input directory to read the metadata "
+                        "from instead of the block and subs files")
+    parser.add_argument("--subject-base", default="",
+                        help="Prefix of the subjects of the --samples genomes")
+    args = parser.parse_args()
+
+    if args.samples is not None:
+        metadata, subjects = sample_items(args.samples, args.subject_base)
+    else:
+        metadata = readitems("block")
+        subjects = readitems("subs")
+
+    with open(args.metadataSchema, "rb") as f:
+        schema_hash = hashlib.sha256(f.read()).hexdigest()
+
+    if args.previous_cache:
+        shutil.copyfile(args.previous_cache, args.cache)
+    cache = sqlite3.connect(args.cache)
+    cache.execute("CREATE TABLE IF NOT EXISTS rdf (key TEXT PRIMARY KEY, nt TEXT NOT NULL)")
+
+    with ProcessPoolExecutor(max_workers=args.jobs, initializer=init_worker,
+                             initargs=(args.metadataSchema,)) as executor:
+        # Cached documents are written as they are, the rest are converted
+        # in the pool and written in input order. At most QUEUED_PER_JOB
+        # documents per worker are queued, so the results of a large
+        # pangenome are not all held in memory.
+        pending = deque()
+        for i, m in enumerate(metadata):
+            key = cache_key(schema_hash, m["path"], subjects[i])
+            row = cache.execute("SELECT nt FROM rdf WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                pending.append((key, None, row[0]))
+            else:
+                pending.append((key, executor.submit(makerdf, m["path"], subjects[i]), None))
+            while len(pending) > args.jobs * QUEUED_PER_JOB:
+                write_rdf(cache, *pending.popleft())
+        while pending:
+            write_rdf(cache, *pending.popleft())
+    cache.commit()
+    cache.close()
+
+    if args.dups:
+        sameseqs = open(args.dups, "rt")
+        for d in sameseqs:
+            logging.warn(d)
+            g = re.match(r"\d+\t(.*)", d)
+            logging.warn("%s", g.group(1))
+            sp = g.group(1).split(",")
+            for n in sp[1:]:
+                print("<%s> <http://biohackathon.org/bh20-seq-schema/has_duplicate_sequence> <%s> ." % (n.strip(), sp[0].strip()))
+
+    orig = open(args.originalLabels, "rt")
+    print(orig.read())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,19 @@
+import sys
+
+# Writes the records of a FASTA file whose names are not in a previous
+# FASTA file, or all records if there is no previous file.
+
+seen = set()
+if len(sys.argv) > 2:
+    with open(sys.argv[2], "rt") as previous:
+        for line in previous:
+            if line.startswith(">"):
+                seen.add(line[1:].split()[0])
+
+keep = False
+with open(sys.argv[1], "rt") as reads:
+    for line in reads:
+        if line.startswith(">"):
+            keep = line[1:].split()[0] not in seen
+        if keep:
+            sys.stdout.write(line)
@@ -1,30 +1,113 @@
-import os
+import argparse
 import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+# Relabels FASTA files with their subjects. Only the header line of every
+# file is read in Python, the sequence data is copied between file
+# descriptors by the kernel.
+#
+# The source of every subject, the collection its file was taken from, is
+# written to sources.tsv so that dedup-seqs.py can tell which sequences
+# changed since an earlier run. Subjects without a known source get an
+# empty one.
 
-def readitems(stem):
+def copy_range(fd_in, fd_out, offset, count):
+    """Appends count bytes of fd_in starting at offset to fd_out."""
+    while count > 0:
+        if hasattr(os, "copy_file_range"):
+            try:
+                n = os.copy_file_range(fd_in, fd_out, count, offset)
+            except OSError:
+                n = os.sendfile(fd_out, fd_in, offset, count)
+        else:
+            n = os.sendfile(fd_out, fd_in, offset, count)
+        if n == 0:
+            break
+        offset += n
+        count -= n
+
+def relabel(shard, items):
+    fasta_name = "relabeledSeqs.%d.fasta" % shard
+    labels_name = "originalLabels.%d.ttl" % shard
+    fd_out = os.open(fasta_name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    with open(labels_name, "wt") as original_labels:
+        for item in items:
+            with open(item["path"], "rb") as fa:
+                label = fa.readline().decode("utf-8")
+                offset = fa.tell()
+                size = os.fstat(fa.fileno()).st_size
+                original_labels.write("<%s> <http://biohackathon.org/bh20-seq-schema/original_fasta_label> \"%s\" .\n" % (item["subject"], label[1:].strip().replace('"', '\\"')))
+                os.write(fd_out, (">" + item["subject"] + "\n").encode("utf-8"))
+                copy_range(fa.fileno(), fd_out, offset, size - offset)
+                if size > offset and os.pread(fa.fileno(), 1, size - 1) != b"\n":
+                    os.write(fd_out, b"\n")
+    os.close(fd_out)
+    return fasta_name, labels_name
+
+def sample_items(samples, subject_base):
+    """Lists the genomes of a pangenome input directory, one for every
+    <sample>/ holding a sequence.fasta and a metadata.yaml, in sample
+    order. Their sources are read from the sources.tsv of the directory
+    if it has one."""
+    sources = {}
+    if os.path.isfile(os.path.join(samples, "sources.tsv")):
+        with open(os.path.join(samples, "sources.tsv")) as f:
+            for line in f:
+                name, source = line.rstrip("\n").split("\t")
+                sources[name] = source
     items = []
-    b = 1
-    while os.path.exists("%s%i" % (stem, b)):
-        with open("%s%i" % (stem, b)) as f:
-            items.extend(json.load(f))
-        b += 1
+    for name in sorted(os.listdir(samples)):
+        path = os.path.join(samples, name, "sequence.fasta")
+        if (os.path.isfile(path) and
+                os.path.isfile(os.path.join(samples, name, "metadata.yaml"))):
+            items.append({"path": path, "subject": subject_base + name,
+                          "source": sources.get(name, "")})
     return items
 
-reads = readitems("block")
-subjects = readitems("subs")
-
-relabeled_fasta = open("relabeledSeqs.fasta", "wt")
-original_labels = open("originalLabels.ttl", "wt")
-
-for i, r in enumerate(reads):
-    with open(r["path"], "rt") as fa:
-        label = fa.readline()
-        original_labels.write("<%s> <http://biohackathon.org/bh20-seq-schema/original_fasta_label> \"%s\" .\n" % (subjects[i], label[1:].strip().replace('"', '\\"')))
-        relabeled_fasta.write(">"+subjects[i]+"\n")
-        data = fa.read(8096)
-        while data:
-            relabeled_fasta.write(data)
-            endswithnewline = data.endswith("\n")
-            data = fa.read(8096)
-        if not endswithnewline:
-            relabeled_fasta.write("\n")
+def concatenate(parts, output):
+    fd_out = os.open(output, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    for part in parts:
+        fd_in = os.open(part, os.O_RDONLY)
+        copy_range(fd_in, fd_out, 0, os.fstat(fd_in).st_size)
+        os.close(fd_in)
+        os.remove(part)
+    os.close(fd_out)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("manifest", nargs="?",
+                        help="JSON list of {\"path\": ..., \"subject\": ..., "
+                        "\"source\": ...}, the source is optional")
+    parser.add_argument("--samples",
+                        help="Pangenome input directory to read the genomes "
+                        "from instead of a manifest")
+    parser.add_argument("--subject-base", default="",
+                        help="Prefix of the subjects of the --samples genomes")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(),
+                        help="Number of shards relabeled in parallel")
+    args = parser.parse_args()
+
+    if args.samples is not None:
+        items = sample_items(args.samples, args.subject_base)
+    elif args.manifest is not None:
+        with open(args.manifest) as f:
+            items = json.load(f)
+    else:
+        parser.error("either a manifest or --samples is required")
+
+    with open("sources.tsv", "wt") as sources:
+        for item in items:
+            sources.write("%s\t%s\n" % (item["subject"], item.get("source", "")))
+
+    jobs = max(1, min(args.jobs, len(items)))
+    shard_size = max(1, (len(items) + jobs - 1) // jobs)
+    shards = [items[i:i + shard_size] for i in range(0, len(items), shard_size)]
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        results = list(executor.map(relabel, range(len(shards)), shards))
+
+    concatenate([fasta for fasta, _ in results], "relabeledSeqs.fasta")
+    concatenate([labels for _, labels in results], "originalLabels.ttl")
+
+if __name__ == "__main__":
+    main()